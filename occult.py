@@ -1,13 +1,120 @@
+import time
+
+# When we started, so each phase of starting up can be timed from it
+start_time = time.time()
+
+import math
+import base64
+import hashlib
+import json
+import mmap
+import optparse
+import os
+import select
+import socket
+import stat
+import struct
+import sys
+import threading
 import wx
-from pygame import font, image, surface
+
+# pygame 2 greets us on stdout when imported, which would land in front of
+# any frames streamed there
+os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"
+from pygame import font, image, surface, SRCALPHA
+
+def system_monotonic():
+    """
+    Return a function reading the operating system's monotonic clock, in
+    seconds, for Pythons without time.monotonic. Unlike wall time, it never
+    jumps when the clock is set, by hand or by NTP. Only if the system has
+    no such clock we can find do we settle for wall time.
+    """
+    import ctypes
+    import ctypes.util
+
+    try:
+        if sys.platform == "win32":
+            kernel32 = ctypes.windll.kernel32
+            frequency = ctypes.c_int64()
+            if not kernel32.QueryPerformanceFrequency(ctypes.byref(frequency)):
+                raise OSError("No performance counter")
+
+            def monotonic():
+                counter = ctypes.c_int64()
+                kernel32.QueryPerformanceCounter(ctypes.byref(counter))
+                return counter.value / float(frequency.value)
+
+        elif sys.platform == "darwin":
+            libc = ctypes.CDLL(ctypes.util.find_library("c"))
+
+            class TimebaseInfo(ctypes.Structure):
+                _fields_ = [("numer", ctypes.c_uint32),
+                            ("denom", ctypes.c_uint32)]
+
+            timebase = TimebaseInfo()
+            libc.mach_timebase_info(ctypes.byref(timebase))
+            libc.mach_absolute_time.restype = ctypes.c_uint64
+            scale = timebase.numer / float(timebase.denom) / 1e9
+
+            def monotonic():
+                return libc.mach_absolute_time() * scale
+
+        else:
+            class Timespec(ctypes.Structure):
+                _fields_ = [("tv_sec", ctypes.c_long),
+                            ("tv_nsec", ctypes.c_long)]
+
+            # clock_gettime moved from librt into libc with glibc 2.17
+            library = ctypes.util.find_library("rt")
+            libc = ctypes.CDLL(library, use_errno=True)
+            clock_gettime = libc.clock_gettime
+            clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+            clock_id = 1
+            if sys.platform.startswith("freebsd"):
+                clock_id = 4
+
+            def monotonic():
+                spec = Timespec()
+                if clock_gettime(clock_id, ctypes.byref(spec)):
+                    errno = ctypes.get_errno()
+                    raise OSError(errno, os.strerror(errno))
+                return spec.tv_sec + spec.tv_nsec / 1e9
+
+        monotonic()
+        return monotonic
+    except (OSError, AttributeError):
+        sys.stderr.write("occult: no monotonic clock found, so clocks will "
+                         "jump if the system time is changed\n")
+        return time.time
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2 has no time.monotonic, so we ask the system for its own
+    monotonic = system_monotonic()
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# NumPy lets us draw smooth, anti-aliased edges. Without it we fall back to
+# glyphs with hard edges
+try:
+    import numpy
+    from pygame import surfarray
+except ImportError:
+    numpy = None
 
 class ClockFrame(wx.Frame):
     """
     The frame responsible for displaying the actual clock.
 
     Reshapes its borders to fit the edges of the clock text image each redraw.
+    Woken to redraw by the ClockScheduler it shares with any other clocks.
     """
-    def __init__(self, parent):
+    def __init__(self, parent, scheduler, clock_id=1):
         self.default_style = wx.FRAME_SHAPED | wx.SIMPLE_BORDER
         style = self.default_style
         if defaults["aot"]:
@@ -18,77 +125,167 @@ class ClockFrame(wx.Frame):
         self.hasShape = False
         self.delta = wx.Point(0,0)
 
+        # The window's current shape and client size, and a key describing
+        # the layout the shape was built for, so we only reshape on change
+        self.shape = None
+        self.shape_key = None
+        self.client_size = None
+
         # Instantiate class members, suck in sane defaults
         self.parent = parent
-        self.time = defaults["sec"]
+        self.scheduler = scheduler
+        self.clock_id = clock_id
+        self.engine = ClockEngine(defaults["sec"], defaults["countup"])
         self.paused = True
+        self.started = False
+
+        # Parts of the clock needing a redraw, and whether one is on its way
+        self.stale = set()
+        self.render_pending = False
         self.color = defaults["clockcolor"]
         self.bgcolor = defaults["bgcolor"]
         self.text_font = defaults["font"]
         self.text_size = defaults["size"]
         self.mask = defaults["mask"]
+
+        # The font size we actually draw at, which is smaller than text_size
+        # if drawing at that size would take more than our memory limit
+        self.draw_size = self.text_size
         self.aot = defaults["aot"]
         self.countup = defaults["countup"]
 
-        # The pygame font object
-        self.font = None
+        # Decimal places of seconds shown, and the units of time that makes
+        self.precision = defaults["precision"]
+        self.scale = 10 ** self.precision
+
+        # The whole seconds on the clock, and what's shown in units of
+        # 1/self.scale seconds
+        self.time = None
+        self.shown = None
+        self.UpdateShown()
+
+        # A running average of how long a render takes, in seconds, used to
+        # pace sub-second clocks
+        self.render_cost = 0.0
+
+        # Pre-rendered glyphs for the current font, size, and colors, and the
+        # font and size they're of
+        self.atlas = None
+        self.atlas_font = None
+
+        # The layout of the text we last checked fits our memory limit, as
+        # text_layout gives it
+        self.fit_layout = None
 
         # A background surface to paint text onto. Stored for faster access
         self.bgsurf = None
 
+        # The pixels behind bgsurf, one palette index per pixel, and the
+        # bitmap we display, which is only ever filled in a strip at a time
+        self.framebuf = None
+        self.bmp = None
+
+        # The atlas and (char, x) cells last drawn onto bgsurf, so the next
+        # frame only has to redraw the cells that differ
+        self.drawn_atlas = None
+        self.drawn_cells = None
+
+        # Renders our upcoming frames ahead of time, off the GUI thread
+        self.prerender = FramePrerenderer(PRERENDER_FRAMES)
+
+        # Anything else that wants each frame as it's rendered
+        self.outputs = []
+        stream = clock_path(defaults["stream"], clock_id)
+        if stream:
+            self.outputs.append(FrameStreamer(stream,
+                                              defaults["stream_fps"],
+                                              defaults["stream_size"],
+                                              defaults["stream_format"]))
+        shm = clock_path(defaults["shm"], clock_id)
+        if shm:
+            self.outputs.append(FrameRing(shm, defaults["shm_size"],
+                                          defaults["shm_format"]))
+
+        # Text files to write our displayed time to
+        self.text_files = []
+        for path in defaults["text_files"]:
+            path = clock_path(path, clock_id)
+            if path:
+                self.text_files.append(path)
+
         # Event bindings to catch clicks and redraws
         self.Bind(wx.EVT_LEFT_DOWN, self.OnLeftDown)
         self.Bind(wx.EVT_LEFT_UP, self.OnLeftUp)
         self.Bind(wx.EVT_MOTION, self.OnMouseMove)
         self.Bind(wx.EVT_PAINT, self.OnPaint)
         self.Bind(wx.EVT_WINDOW_CREATE, self.SetWindowShape)
-
-        # Run self.OnTimer every 1 second
-        self.timer = wx.Timer(self, -1)
-        self.timer.Start(1000)
-        self.Bind(wx.EVT_TIMER, self.OnTimer)
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.OnDestroy)
 
     def redraw_background(self, img_size):
         """
         Re-generate the background surface, in the event that the needed
         background size, or color, changes.
+
+        The surface draws directly into self.framebuf, palettized with the
+        atlas's colors, so we only allocate when the size changes. The
+        next frame is drawn from scratch.
         """
-        self.bgsurf = surface.Surface(img_size)
-        self.bgsurf.fill(self.bgcolor)        
+        if self.bgsurf is None or self.bgsurf.get_size() != tuple(img_size):
+            width, height = img_size
+            self.framebuf = bytearray(width * height)
+            self.bgsurf = image.frombuffer(self.framebuf, img_size, "P")
+            self.bmp = wx.EmptyBitmap(width, height, 24)
+
+        # Whatever was drawn before is gone now
+        self.drawn_cells = None
 
     def SetOptions(self, sec=None, color=None, bgcolor=None, text_font=None,
-                   text_size=None, mask=None, aot=None, countup=None):
+                   text_size=None, mask=None, aot=None, countup=None,
+                   precision=None):
         """
-        Change options stored as instance variables, and do immediate logic
-        needed to make those changes take effect before the next redraw.
+        Change options stored as instance variables, and mark whatever they
+        affect as needing a redraw. The redraw itself happens once, in Render,
+        however many options are changed in the meantime.
         """
+        # Frames rendered ahead of time no longer show what's coming next if
+        # the time, colors, font, or direction change
+        if (sec is not None or
+                color is not None and color != self.color or
+                bgcolor is not None and bgcolor != self.bgcolor or
+                text_font is not None and text_font != self.text_font or
+                text_size is not None and text_size != self.text_size or
+                countup is not None and countup != self.countup or
+                precision is not None and precision != self.precision or
+                mask is not None and mask != self.mask):
+            self.prerender.discard()
+
         if sec is not None:
-            self.time = sec
+            self.engine.set(sec)
+            self.UpdateShown()
+            self.Invalidate("text")
 
-        if color is not None:
+        if color is not None and color != self.color:
             self.color = color
+            self.Invalidate("colors")
 
-        if bgcolor is not None:
-            if bgcolor != self.bgcolor:
-                self.bgcolor = bgcolor
+        if bgcolor is not None and bgcolor != self.bgcolor:
+            self.bgcolor = bgcolor
+            self.Invalidate("colors", "background")
 
-                # If our bgcolor has changed, redraw the background surface
-                self.redraw_background(self.bgsurf.get_size())
+        if text_font is not None and text_font != self.text_font:
+            self.text_font = text_font
+            self.Invalidate("font")
 
-        if text_font is not None or text_size is not None or self.font is None:
-            if text_font is None:
-                text_font = self.text_font
-            else:
-                self.text_font = text_font
-            if text_size is None:
-                text_size = self.text_size
-            else:
-                self.text_size = text_size
+        if text_size is not None and text_size != self.text_size:
+            self.text_size = text_size
+            self.Invalidate("font")
 
-            self.font = load_font(text_font, text_size)
+        if self.atlas is None:
+            self.Invalidate("font")
 
-        if mask is not None:
+        if mask is not None and mask != self.mask:
             self.mask = mask
+            self.Invalidate("shape", "colors")
 
         if aot is not None and aot != self.aot:
             self.aot = aot
@@ -98,73 +295,420 @@ class ClockFrame(wx.Frame):
 
             self.SetWindowStyle(style)
 
-        if countup is not None:
+        if countup is not None and countup != self.countup:
             self.countup = countup
+            self.engine.set_countup(countup)
+            self.UpdateShown()
+            self.Invalidate("text")
+
+        if precision is not None and precision != self.precision:
+            self.precision = precision
+            self.scale = 10 ** precision
+            self.UpdateShown()
+            self.Invalidate("text")
+
+        self.ScheduleTick()
+        self.PublishState()
+
+    def Invalidate(self, *parts):
+        """
+        Mark parts of the clock ("font", "colors", "background", "shape", or
+        "text") as stale, and make sure a render is coming to bring them up to
+        date on the next pass of the event loop.
+        """
+        self.stale.update(parts)
+        if not self.render_pending:
+            self.render_pending = True
+            wx.CallAfter(self.Render)
+
+    def Render(self):
+        """
+        Bring everything invalidated since the last render up to date, and
+        redraw the clock once.
+        """
+        # We may have been closed while the render was on its way
+        if not self:
+            return
+
+        self.render_pending = False
+        stale = self.stale
+        self.stale = set()
+        if not stale:
+            return
+        start = mark = monotonic()
+
+        # Without a window there's nothing to draw, only text to write
+        if not defaults["window"]:
+            self.WriteText()
+            stats.count("renders")
+            stats.phase("first frame")
+            return
+
+        if "font" in stale:
+            self.draw_size = self.text_size
+            self.fit_layout = None
+
+        # Draw smaller rather than run past our memory limit. Only a change
+        # of font or in the text's width can change how much we need
+        layout = text_layout(format_time(self.shown, self.precision))
+        if layout != self.fit_layout:
+            self.fit_layout = layout
+            if self.FitMemory():
+                stale.add("font")
+
+        if "font" in stale or "colors" in stale:
+            self.atlas = self.GetAtlas(self.color)
+            self.atlas_font = (self.text_font, self.draw_size)
+            mark = stats.lap("atlas", mark)
+            stats.phase("glyphs")
+
+        # If our bgcolor has changed, redraw the background surface
+        if "background" in stale and self.bgsurf is not None:
+            self.redraw_background(self.bgsurf.get_size())
+            mark = stats.lap("background", mark)
+
+        # Text and shape are brought up to date by SetImage itself, which
+        # only redraws the cells and reshapes the window as needed
+        self.SetImage(self.shown, self.color, self.mask)
+        self.WriteText()
+
+        # New clocks stay hidden until there's something to show
+        if not self.IsShown():
+            self.Show()
+            stats.phase("first frame")
+
+        cost = monotonic() - start
+        self.render_cost += (cost - self.render_cost) * RENDER_COST_WEIGHT
+        stats.stage("render", cost)
+        stats.count("renders")
+
+    def SetPaused(self, paused):
+        """
+        Pause or resume time keeping.
+        """
+        self.paused = paused
+        if paused:
+            self.engine.pause()
+        else:
+            self.engine.start()
+            self.started = True
+        self.ScheduleTick()
+        self.PublishState()
+
+    def GetState(self):
+        """
+        Return the clock's state as a dict fit for JSON. While running, the
+        time on the clock is "time" plus or minus however long it has been
+        since "anchor" on our monotonic clock, or "wall" on the wall clock.
+        """
+        return {
+            "time": self.engine.base,
+            "paused": self.paused,
+            "countup": self.countup,
+            "anchor": self.engine.anchor,
+            "wall": self.engine.wall_anchor,
+            "color": list(self.color),
+            "bgcolor": list(self.bgcolor),
+            "font": self.text_font,
+            "size": self.text_size,
+            "mask": self.mask,
+            "aot": self.aot,
+            "precision": self.precision
+        }
+
+    def PublishState(self):
+        if state_server is None and journal is None:
+            return
+        state = self.GetState()
+        if state_server is not None:
+            state_server.publish(self.clock_id, state)
+        if journal is not None:
+            journal.record(self.clock_id, state)
+
+    def Restore(self, state):
+        """
+        Pick up where a clock with the given state, from GetState, left off:
+        one replayed from the journal after occult was closed or crashed.
+        """
+        self.SetOptions(color=tuple(state["color"]),
+                        bgcolor=tuple(state["bgcolor"]),
+                        text_font=state["font"], text_size=state["size"],
+                        mask=state["mask"], aot=state.get("aot", self.aot),
+                        countup=state["countup"],
+                        precision=state["precision"])
+
+        # Carry on running for however long it's been since the anchor
+        self.engine.base = state["time"]
+        self.engine.set_anchor(None)
+        self.paused = state["paused"]
+        if not self.paused:
+            self.engine.set_anchor(monotonic() -
+                                   resume_elapsed(state, monotonic(),
+                                                  time.time()))
+            self.started = True
+
+        self.prerender.discard()
+        self.UpdateShown()
+        self.Invalidate("text")
+        self.ScheduleTick()
+        self.PublishState()
+
+    def ScheduleTick(self):
+        """
+        Have the scheduler wake us just after the displayed time next changes.
+        """
+        self.scheduler.Schedule(self)
+
+    def TickDelay(self, now):
+        """
+        Return how long from now the scheduler should next wake us, or None
+        if it needn't. Sub-second clocks are paced: woken no more often than
+        the display refreshes, nor so often that rendering takes more than
+        its share of the GUI thread. In between, frames are skipped rather
+        than falling behind.
+        """
+        delay = self.engine.next_change(now, self.scale)
+        if delay is None or self.precision == 0:
+            return delay
+
+        interval = max(1.0 / refresh_rate(),
+                       self.render_cost / defaults["cpu_budget"])
+        return max(delay, interval)
+
+    def UpdateShown(self):
+        """
+        Read the time to show off the engine. Returns True if it changed.
+        """
+        shown = self.engine.ticks(scale=self.scale)
+        changed = shown != self.shown
+        self.shown = shown
+        self.time = self.engine.display()
+        return changed
+
+    def FitMemory(self):
+        """
+        Shrink the font we draw with until frames of the text we're showing
+        fit in our memory limit. Returns True if the font changed. We don't
+        grow back until the font or its size is changed.
+        """
+        limit = defaults["memory_limit"] * 1024 * 1024
+        text = format_time(self.shown, self.precision)
+        size = self.draw_size
+        cost = frame_bytes(self.MeasureText(text))
+        if cost <= limit:
+            return False
+
+        while cost > limit and self.draw_size > 1:
+            # Memory goes with the square of the font size
+            self.draw_size = max(min(int(self.draw_size *
+                                         math.sqrt(float(limit) / cost)),
+                                     self.draw_size - 1), 1)
+            cost = frame_bytes(self.MeasureText(text))
+
+        stats.count("downscales")
+        sys.stderr.write("occult: clock %d drawn at %dpt, not %dpt, to fit in "
+                         "%dMB\n" % (self.clock_id, self.draw_size, size,
+                                      defaults["memory_limit"]))
+        return True
+
+    def MeasureText(self, text):
+        """
+        Return the size text would be drawn at, from our atlas if it's of the
+        font and size we're drawing in.
+        """
+        if (self.atlas is not None and
+                self.atlas_font == (self.text_font, self.draw_size)):
+            return self.atlas.text_size(text)
+        return measure_text(self.text_font, self.draw_size, text)
+
+    def GetAtlas(self, color):
+        """
+        Return the glyph atlas to draw in color with. Smooth edges blend into
+        the background, so they're only used while the background is shown;
+        a masked clock's shape needs every pixel to be either glyph or
+        background.
+        """
+        return get_atlas(self.text_font, self.draw_size, color, self.bgcolor,
+                         defaults["smooth"] and not self.mask)
 
-        # Update the image to force new settings to take effect
-        self.SetImage(self.time, self.color, self.mask)
+    def WriteText(self):
+        """
+        Queue the time we're showing to be written to our text files. The
+        writer skips any file whose text hasn't changed.
+        """
+        if self.text_files:
+            text = format_time(self.shown, self.precision)
+            for path in self.text_files:
+                text_writer.write(path, text)
 
     def SetImage(self, sec, color, mask):
-        # Split the seconds up into d/h/m/s
-        timelist = []
-        timelist.append("%02d" % (sec / 86400))
-        sec = sec % 86400
-        timelist.append("%02d" % (sec / 3600))
-        sec = sec % 3600
-        timelist.append("%02d" % (sec / 60))
-        sec = sec % 60
-        timelist.append("%02d" % sec)
-
-        # Pop left-hand 0's until just m/s are left, if < 1hr
-        while timelist[0] == "00" and len(timelist) > 2:
-            timelist.pop(0)
-
-        # Turn that into a single string and render it
-        text = ':'.join(timelist)
-        text = self.font.render(text, 0, color, self.bgcolor)
-
-        # Make sure our background surface is big enough. Grow it if not
-        img_size = text.get_size()
-        if self.bgsurf is None:
+        """
+        Draw the clock showing sec, in units of 1/self.scale seconds.
+        """
+        # Glyphs come from the cached atlas unless we've been asked to draw
+        # in a color other than our own
+        atlas = self.atlas
+        if color != self.color:
+            atlas = self.GetAtlas(color)
+
+        text = format_time(sec, self.precision)
+        mark = monotonic()
+
+        # Fit our background surface to the text, growing or shrinking it.
+        # Digits all take the same width, so this only happens when fields
+        # come or go, or the font changes
+        img_size = atlas.text_size(text)
+        if self.bgsurf is None or self.bgsurf.get_size() != img_size:
             self.redraw_background(img_size)
-        else:
-            bgsurf_size = self.bgsurf.get_size()
-            if bgsurf_size[0] < img_size[0] or bgsurf_size[1] < img_size[1]:
-                self.redraw_background(img_size)
 
         # Figure out where to blit text to background so it's centerprinted
         bgsurf_size = self.bgsurf.get_size()
-        justify = (bgsurf_size[0] - img_size[0]) / 2
-
-        # Blank our background, blit text
-        self.bgsurf.fill(self.bgcolor)
-        self.bgsurf.blit(text, (justify, 0))
-
-        # Create the wx surface and load in the pygame surface's image_string
-        image_string = image.tostring(self.bgsurf, "RGB")
-        surf = wx.EmptyImage(*bgsurf_size)
-        surf.SetData(image_string)
-        surf.SetMaskColour(*self.bgcolor)
-        surf.SetMask(mask) 
-        self.bmp = surf.ConvertToBitmap()         
-
-        # Shrink window and shape around image
-        self.SetClientSize((self.bmp.GetWidth(), self.bmp.GetHeight()))
-        self.SetWindowShape()
-        dc = wx.ClientDC(self)
-        dc.DrawBitmap(self.bmp, 0,0, True)
+        justify = (bgsurf_size[0] - img_size[0]) // 2
+
+        # If the cells sit where they did last frame, redraw only the ones
+        # whose character has changed. Otherwise start from a blank background
+        cells = atlas.layout(text, justify)
+        same_layout = (atlas is self.drawn_atlas and
+                       self.drawn_cells is not None and
+                       [x for char, x in cells] ==
+                       [x for char, x in self.drawn_cells])
+        if same_layout:
+            dirty = [cell for cell, drawn in zip(cells, self.drawn_cells)
+                     if cell != drawn]
+
+        # If this frame was rendered ahead of time, swap it in rather than
+        # drawing it now, leaving only the bitmap to bring up to date
+        frame = self.prerender.take(atlas, bgsurf_size, self.bgcolor, text)
+        if frame is not None:
+            self.prerender.recycle(self.framebuf)
+            self.framebuf, self.bgsurf = frame
+
+        if same_layout and frame is not None:
+            self.DrawBitmapCells(atlas, dirty)
+        elif same_layout:
+            self.DrawCells(atlas, dirty)
+        elif frame is not None:
+            draw_frame(self.bmp, self.bgsurf)
+            self.RefreshRect(wx.Rect(0, 0, *bgsurf_size), False)
+        else:
+            self.bgsurf.set_palette(atlas.palette)
+            compose_frame(self.bgsurf, atlas, text, self.bgcolor)
+
+            # bgsurf has drawn straight into framebuf; expand that into the
+            # bitmap rather than keeping a full color copy of the frame
+            draw_frame(self.bmp, self.bgsurf)
+            self.RefreshRect(wx.Rect(0, 0, *bgsurf_size), False)
+
+        self.drawn_atlas = atlas
+        self.drawn_cells = cells
+        mark = stats.lap("draw", mark)
+
+        # Shrink window and shape around image, if the layout has changed.
+        # With the background shown our shape is just our size; with it masked
+        # out it depends on exactly which glyphs sit where
+        if bgsurf_size != self.client_size:
+            self.client_size = bgsurf_size
+            self.SetClientSize(bgsurf_size)
+            stats.count("resizes")
+
+        if mask:
+            shape_key = (True, bgsurf_size, atlas, text, justify)
+        else:
+            shape_key = (False, bgsurf_size)
+
+        if shape_key != self.shape_key:
+            self.shape_key = shape_key
+            self.shape = build_shape(atlas, text, justify, bgsurf_size, mask)
+            self.SetWindowShape()
+            stats.count("reshapes")
+        mark = stats.lap("shape", mark)
+
+        # Paint whatever we've marked as changed right away
+        self.Update()
+        mark = stats.lap("paint", mark)
+
+        for output in self.outputs:
+            output.publish(self, text)
+        if self.outputs:
+            mark = stats.lap("outputs", mark)
+
+        # Get started on the frames we'll need next. Sub-second clocks skip
+        # too many frames for that to be worthwhile
+        if not self.paused and self.precision == 0:
+            self.prerender.request(atlas, bgsurf_size, self.bgcolor,
+                                   [format_time(value) for value in
+                                    self.engine.upcoming(PRERENDER_FRAMES)])
+
+    def DrawCells(self, atlas, cells):
+        """
+        Redraw just the given (char, x) cells, in both bgsurf and the bitmap,
+        and mark them for repainting.
+        """
+        for char, x in cells:
+            self.bgsurf.fill(self.bgcolor,
+                             (x, 0, atlas.cell_width(char), atlas.height))
+            self.bgsurf.blit(atlas.glyphs[char],
+                             (x + atlas.glyph_offset(char), 0))
+        self.DrawBitmapCells(atlas, cells)
+
+    def DrawBitmapCells(self, atlas, cells):
+        """
+        Redraw just the given (char, x) cells in the bitmap, and mark them for
+        repainting.
+        """
+        if not cells:
+            return
+
+        dc = wx.MemoryDC(self.bmp)
+        dc.SetPen(wx.TRANSPARENT_PEN)
+        dc.SetBrush(wx.Brush(wx.Colour(*self.bgcolor)))
+        for char, x in cells:
+            width = atlas.cell_width(char)
+            glyph_x = x + atlas.glyph_offset(char)
+
+            dc.DrawRectangle(x, 0, width, atlas.height)
+            dc.DrawBitmap(atlas.glyph_bitmap(char), glyph_x, 0)
+
+            self.RefreshRect(wx.Rect(x, 0, width, atlas.height), False)
+        dc.SelectObject(wx.NullBitmap)
 
     def SetWindowShape(self, evt=None):
-        r = wx.RegionFromBitmap(self.bmp)
-        self.hasShape = self.SetShape(r)
+        if self.shape is not None:
+            self.hasShape = self.SetShape(self.shape)
 
     def OnPaint(self, evt):
+        """
+        Repaint only the parts of the window that have been invalidated.
+        Transparency is handled by the window's shape, so the bitmap needs no
+        mask of its own.
+        """
         dc = wx.PaintDC(self)
-        dc.DrawBitmap(self.bmp, 0,0, True)
+        if self.bmp is None:
+            return
+
+        src = wx.MemoryDC(self.bmp)
+        rects = wx.RegionIterator(self.GetUpdateRegion())
+        while rects.HaveRects():
+            rect = rects.GetRect()
+            dc.Blit(rect.x, rect.y, rect.width, rect.height, src,
+                    rect.x, rect.y)
+            rects.Next()
+        src.SelectObject(wx.NullBitmap)
 
     def OnExit(self, evt):
         self.Close()
 
+    def OnDestroy(self, evt):
+        if evt.GetEventObject() is self:
+            self.scheduler.Remove(self)
+            self.prerender.close()
+            for output in self.outputs:
+                output.close()
+            self.outputs = []
+            if state_server is not None:
+                state_server.unpublish(self.clock_id)
+        evt.Skip()
+
     def OnLeftDown(self, evt):
         """
         Allow for dragging of the clock around the screen via the LMB.
@@ -188,17 +732,36 @@ class ClockFrame(wx.Frame):
         if self.HasCapture():
             self.ReleaseMouse()
 
-    def OnTimer(self, evt):
+    def Tick(self):
         """
-        Timer set to tick every 1000ms. Tick clock by 1 second unless we're
-        paused.
+        Called by the scheduler just after the display changes. Read the time
+        off the engine rather than counting ticks, so a late or dropped timer
+        event can't lose time, and redraw.
         """
-        if not self.paused:
-            self.time += 1 if self.countup else -1
-            if self.time < 0:
-                self.time = 0
+        if self.UpdateShown():
+            self.Invalidate("text")
+
+class StatsFrame(wx.Frame):
+    """
+    Shows timing statistics and counters for every clock, refreshed once a
+    second.
+    """
+    def __init__(self, parent):
+        wx.Frame.__init__(self, parent, -1, "OCCult Clock Stats",
+                          size=(560, 420))
+
+        self.text = wx.TextCtrl(self, -1, style=wx.TE_MULTILINE |
+                                wx.TE_READONLY | wx.TE_DONTWRAP)
+        self.text.SetFont(wx.Font(9, wx.FONTFAMILY_TELETYPE,
+                                  wx.FONTSTYLE_NORMAL, wx.FONTWEIGHT_NORMAL))
 
-            self.SetImage(self.time, self.color, self.mask)
+        self.timer = wx.Timer(self, -1)
+        self.Bind(wx.EVT_TIMER, self.OnTimer, self.timer)
+        self.timer.Start(1000)
+        self.OnTimer(None)
+
+    def OnTimer(self, evt):
+        self.text.SetValue(stats.report())
 
 class ControlFrame(wx.Frame):
     """
@@ -211,8 +774,12 @@ class ControlFrame(wx.Frame):
                           style=wx.DEFAULT_FRAME_STYLE ^ wx.MAXIMIZE_BOX ^
                           wx.RESIZE_BORDER)
 
-        # Storage of our child widget (the clock itself)
+        # Storage of our clocks, the one the controls are addressing, and
+        # the scheduler that wakes them all
+        self.clocks = []
         self.child = None
+        self.next_clock_id = 1
+        self.scheduler = ClockScheduler(self)
 
         # One panel for the control frame.
         # TAB_TRAVERSAL to allow tabbing between fields
@@ -267,7 +834,7 @@ class ControlFrame(wx.Frame):
         self.f = wx.TextCtrl(pan, -1, style=wx.TE_PROCESS_ENTER)
         self.f.write(defaults["font"])
 
-        self.fs = wx.SpinCtrl(pan, -1, min=0, max=4096, size=(50, 20),
+        self.fs = wx.SpinCtrl(pan, -1, min=1, max=4096, size=(50, 20),
                               style=wx.TE_PROCESS_ENTER | wx.SP_ARROW_KEYS |
                               wx.SP_WRAP )
         self.fs.SetValue(defaults["size"])
@@ -284,6 +851,21 @@ class ControlFrame(wx.Frame):
         self.countup = wx.CheckBox(pan, -1)
         self.countup.SetValue(defaults["countup"])
 
+        # Decimal places of seconds
+        self.precision = wx.SpinCtrl(pan, -1, min=0, max=2, size=(50, 20),
+                                     style=wx.TE_PROCESS_ENTER |
+                                     wx.SP_ARROW_KEYS | wx.SP_WRAP)
+        self.precision.SetValue(defaults["precision"])
+
+        # Clock selection, and buttons to add and remove clocks
+        self.which = wx.Choice(pan, -1)
+        self.new = wx.Button(pan, -1, label="New")
+        self.close = wx.Button(pan, -1, label="Close")
+
+        # Button to show timing statistics, and the frame showing them
+        self.stats = wx.Button(pan, -1, label="Stats")
+        self.stats_frame = None
+
         # Set, pause, and get buttons
         self.set = wx.Button(pan,-1, label="Set")
         self.get = wx.Button(pan, -1, label="Get")
@@ -291,7 +873,7 @@ class ControlFrame(wx.Frame):
 
         for control in (self.hr, self.min, self.sec, self.r,
                         self.g, self.b, self.br, self.bg, self.bb,
-                        self.f, self.fs):
+                        self.f, self.fs, self.precision):
             self.Bind(wx.EVT_TEXT_ENTER, self.OnSetButton, control)
 
         # Create binds for the three control buttons
@@ -299,6 +881,21 @@ class ControlFrame(wx.Frame):
         self.Bind(wx.EVT_BUTTON, self.OnPauseButton, self.pause)
         self.Bind(wx.EVT_BUTTON, self.OnGetButton, self.get)
 
+        self.Bind(wx.EVT_CHOICE, self.OnChoice, self.which)
+        self.Bind(wx.EVT_BUTTON, self.OnNewButton, self.new)
+        self.Bind(wx.EVT_BUTTON, self.OnCloseButton, self.close)
+        self.Bind(wx.EVT_BUTTON, self.OnStatsButton, self.stats)
+
+        # Periodically dump statistics to a file, if asked to
+        if defaults["stats_file"]:
+            self.stats_timer = wx.Timer(self, -1)
+            self.Bind(wx.EVT_TIMER, self.OnStatsTimer, self.stats_timer)
+            self.stats_timer.Start(int(defaults["stats_interval"] * 1000))
+
+        # Bring back whatever clocks were running when we last stopped
+        if journal is not None:
+            wx.CallAfter(self.RestoreClocks, journal.replay())
+
         # Begin widget packing
 
         # Sizers for each group of elements
@@ -313,6 +910,7 @@ class ControlFrame(wx.Frame):
 
         options_sizer = wx.GridBagSizer()
 
+        clocks_sizer = wx.BoxSizer(wx.HORIZONTAL)
         buttons_sizer = wx.BoxSizer(wx.HORIZONTAL)
 
         # Fill the bottom level sizers with widgets
@@ -342,9 +940,17 @@ class ControlFrame(wx.Frame):
                                (wx.StaticText(pan, label="Always On Top"),
                                               (1, 1)),
                                (self.countup, (2, 0)),
-                               (wx.StaticText(pan, label="Count Up"), (2, 1))
+                               (wx.StaticText(pan, label="Count Up"), (2, 1)),
+                               (self.precision, (3, 0)),
+                               (wx.StaticText(pan, label="Decimals"), (3, 1))
                                ])
 
+        clocks_sizer.AddMany([(self.which, 1, wx.EXPAND),
+                              (self.new, 0, wx.ALL),
+                              (self.close, 0, wx.ALL),
+                              (self.stats, 0, wx.ALL)
+                              ])
+
         buttons_sizer.AddMany([(self.set, 0, wx.ALIGN_BOTTOM),
                                (self.get, 0, wx.ALIGN_BOTTOM),
                                (self.pause, 0, wx.ALIGN_BOTTOM)
@@ -365,6 +971,7 @@ class ControlFrame(wx.Frame):
                             ])
 
         right_sizer.AddMany([(options_sizer, 1, wx.EXPAND),
+                             (clocks_sizer, 0, wx.EXPAND),
                              (buttons_sizer, 1, wx.ALIGN_BOTTOM)
                              ])
 
@@ -409,6 +1016,11 @@ class ControlFrame(wx.Frame):
         aot = self.aot.GetValue()
         countup = self.countup.GetValue()
 
+        try:
+            precision = int(self.precision.GetValue())
+        except:
+            precision = None
+
         # Turn h/m/s into seconds
         total = 0
         try:
@@ -445,34 +1057,195 @@ class ControlFrame(wx.Frame):
 
         # Create our clock frame if it's non-existent
         if self.child is None:
-            self.child = ClockFrame(self)
-            self.child.SetOptions()
-            self.child.Show()
+            self.AddClock()
 
         # Set appropriate options
         self.child.SetOptions(total, (r, g, b), (br, bg, bb), font,
-                              font_size, mask, aot, countup)
+                              font_size, mask, aot, countup, precision)
 
         # Grab what we just set back into the text inputs
         # This makes sure assumed defaults get populated back into the controls
         self.OnGetButton(None)
 
-        # Force the child (clock) image to update
-        self.child.SetImage(total, (r, g, b), mask)
-
     def OnPauseButton(self, evt):
         # Create a clock frame with some defaults if no clock frame exists
         if self.child is None:
-            self.child = ClockFrame(self)
-            self.child.SetOptions()
-            self.child.Show()
+            self.AddClock()
 
             # Grab our defaults into the text inputs
             self.OnGetButton(None)
 
         # Flip paused status on button and clock frame
-        self.child.paused = False if self.child.paused else True
-        self.pause.Label = "Resume" if self.child.paused else "Pause"
+        self.child.SetPaused(False if self.child.paused else True)
+        self.UpdatePauseLabel()
+
+    def UpdatePauseLabel(self):
+        if self.child is None or not self.child.started:
+            self.pause.Label = "Start"
+        else:
+            self.pause.Label = "Resume" if self.child.paused else "Pause"
+
+    def AddClock(self, clock_id=None):
+        """
+        Create a new clock with default settings, and address the controls
+        to it. Clocks are numbered in order unless given an ID.
+        """
+        if clock_id is None:
+            clock_id = self.next_clock_id
+
+        # The clock shows itself once it has rendered its first frame
+        clock = ClockFrame(self, self.scheduler, clock_id)
+        clock.SetOptions()
+
+        self.clocks.append(clock)
+        self.which.Append("Clock %d" % clock_id)
+        self.next_clock_id = max(self.next_clock_id, clock_id + 1)
+        self.SelectClock(len(self.clocks) - 1)
+
+    def RestoreClocks(self, states):
+        """
+        Bring back clocks replayed from the journal, as a dict of GetState()
+        states keyed by clock ID.
+        """
+        for clock_id in sorted(states, key=int):
+            self.AddClock(int(clock_id))
+            self.child.Restore(states[clock_id])
+        if self.clocks:
+            self.SelectClock(0)
+
+    def SelectClock(self, index):
+        """
+        Address the controls to the clock at the given index, or to nothing if
+        the index is None.
+        """
+        if index is None:
+            self.child = None
+        else:
+            self.child = self.clocks[index]
+            self.which.SetSelection(index)
+            self.OnGetButton(None)
+        self.UpdatePauseLabel()
+
+    def OnChoice(self, evt):
+        self.SelectClock(self.which.GetSelection())
+
+    def OnNewButton(self, evt):
+        # A new clock starts from whatever the controls currently say
+        self.AddClock()
+        self.OnSetButton(None)
+
+    def OnStatsButton(self, evt):
+        # Show the stats frame, or bring it back if it's been closed
+        if not self.stats_frame:
+            self.stats_frame = StatsFrame(self)
+        self.stats_frame.Show()
+        self.stats_frame.Raise()
+
+    def OnStatsTimer(self, evt):
+        stats.dump(defaults["stats_file"])
+
+    def OnCloseButton(self, evt):
+        if self.child is None:
+            return
+
+        index = self.clocks.index(self.child)
+        self.scheduler.Remove(self.child)
+        if journal is not None:
+            journal.forget(self.child.clock_id)
+        self.child.Destroy()
+        del self.clocks[index]
+        self.which.Delete(index)
+
+        if self.clocks:
+            self.SelectClock(min(index, len(self.clocks) - 1))
+        else:
+            self.SelectClock(None)
+
+    def RunCommand(self, command):
+        """
+        Carry out one command from the control server, and return the state
+        of the clocks it addressed. Raises ValueError if the command makes no
+        sense.
+        """
+        name = command.get("cmd")
+        if name not in ("start", "pause", "set", "get", "new"):
+            raise ValueError("Unknown command %r" % (name,))
+
+        # Work out what to set before touching any clocks
+        options = {}
+        if name == "set":
+            options = command_options(command)
+
+        # Starting or setting with no clocks makes one, like the buttons do
+        if name == "new" or name in ("start", "set") and not self.clocks:
+            self.AddClock()
+        if name == "new":
+            clocks = [self.child]
+        else:
+            clocks = self.FindClocks(command.get("clock"))
+
+        for clock in clocks:
+            if name in ("start", "pause"):
+                clock.SetPaused(name == "pause")
+            elif name == "set":
+                clock.SetOptions(**options)
+
+        result = {}
+        for clock in clocks:
+            state = clock.GetState()
+            state["display"] = format_time(clock.shown, clock.precision)
+            result[str(clock.clock_id)] = state
+        return {"clocks": result}
+
+    def RunCommands(self, commands):
+        """
+        Carry out a batch of commands from the control server, returning a
+        result for each, and bring the controls up to date once at the end.
+        Commands for clock "new" go to the last clock the batch made.
+        """
+        results = []
+        created = None
+        for command in commands:
+            try:
+                if not isinstance(command, dict):
+                    raise ValueError("Commands must be JSON objects")
+                if command.get("clock") == "new":
+                    if created is None:
+                        raise ValueError("No new clock to address")
+                    command = dict(command)
+                    command["clock"] = created.clock_id
+                result = self.RunCommand(command)
+                result["ok"] = True
+                if command["cmd"] == "new":
+                    created = self.child
+            except (ValueError, TypeError, KeyError):
+                result = {"ok": False, "error": str(sys.exc_info()[1])}
+            results.append(result)
+
+        if self.child is not None:
+            self.OnGetButton(None)
+        self.UpdatePauseLabel()
+        return results
+
+    def FindClocks(self, which):
+        """
+        Return the clocks with the given ID, or list of IDs, or every clock if
+        which is None.
+        """
+        if which is None:
+            return list(self.clocks)
+        if not isinstance(which, list):
+            which = [which]
+
+        clocks = []
+        for clock_id in which:
+            for clock in self.clocks:
+                if str(clock.clock_id) == str(clock_id):
+                    clocks.append(clock)
+                    break
+            else:
+                raise ValueError("No clock %s" % (clock_id,))
+        return clocks
 
     def OnGetButton(self, evt):
         # If we don't have a clock frame, do nothing
@@ -513,60 +1286,2630 @@ class ControlFrame(wx.Frame):
         self.mask.SetValue(False if self.child.mask else True)
         self.aot.SetValue(self.child.aot)
         self.countup.SetValue(self.child.countup)
+        self.precision.SetValue(self.child.precision)
 
-def load_font(font_name, font_size):
+class Histogram(object):
     """
-    Attempt to load a font of the given name and size. Attempt in this order:
+    Counts of recorded values, bucketed to two significant figures in the
+    manner of an HDR histogram, so any range of values is kept to the same
+    relative precision in a bounded amount of memory.
+    """
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        value = max(int(value), 0)
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+        # Round down to two significant figures
+        if value >= 100:
+            magnitude = 10 ** (len(str(value)) - 2)
+            value = value // magnitude * magnitude
+        self.buckets[value] = self.buckets.get(value, 0) + 1
+
+    def percentile(self, fraction):
+        """
+        Return the smallest bucket at or below which the given fraction of
+        recorded values fall.
+        """
+        seen = 0
+        for value in sorted(self.buckets):
+            seen += self.buckets[value]
+            if seen >= fraction * self.count:
+                return value
+        return 0
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": self.total / float(self.count),
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "p999": self.percentile(0.999),
+            "max": self.max
+        }
+
+class Stats(object):
+    """
+    Instrumentation for every clock in the process: how late timer wakeups
+    are, how long each stage of a render takes, both as histograms in
+    microseconds, counts of notable events, and how long starting up took.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.lateness = Histogram()
+        self.stages = {}
+        self.counters = {}
 
-    1.) Attempt to load a font of the given name from the PWD
-    2.) Append .ttf to the end and try again, if the name doesn't end in .ttf
-    3.) Attempt to return a system font
-    4.) Panic and return the system font "Sans", which should exist
+        # Each phase of starting up, in the order reached, and the seconds
+        # since start_time it was reached at
+        self.startup = []
 
-    This is made complex by pyinstaller's propensity to make created EXEs crash
-    when calling SysFont(), presumably due to not bundling Pygame's default
-    font into the EXE properly.
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def stage(self, name, seconds):
+        if name not in self.stages:
+            self.stages[name] = Histogram()
+        self.stages[name].record(seconds * 1000000)
+
+    def lap(self, name, mark):
+        """
+        Record the time since mark against a stage, and return the time now
+        to mark the start of the next.
+        """
+        now = monotonic()
+        self.stage(name, now - mark)
+        return now
+
+    def late(self, seconds):
+        self.lateness.record(seconds * 1000000)
+
+    def phase(self, name):
+        """
+        Note that starting up has reached the phase called name, unless it
+        already has. Once the first clock has drawn its first frame, the
+        phases are printed if defaults["startup_times"] asks for them.
+        """
+        if name in [phase for phase, seconds in self.startup]:
+            return
+        self.startup.append((name, time.time() - start_time))
+        if name == "first frame" and defaults["startup_times"]:
+            sys.stderr.write(self.startup_report() + "\n")
+
+    def startup_report(self):
+        """
+        Return how long each phase of starting up took, and when it ended,
+        in milliseconds since start_time.
+        """
+        lines = ["%-12s %9s %9s" % ("startup (ms)", "took", "at")]
+        last = 0
+        for name, seconds in self.startup:
+            lines.append("%-12s %9.1f %9.1f" %
+                         (name, (seconds - last) * 1000, seconds * 1000))
+            last = seconds
+        return "\n".join(lines)
+
+    def summary(self):
+        return {
+            "time": time.time(),
+            "uptime": time.time() - self.started,
+            "lateness_us": self.lateness.summary(),
+            "stages_us": dict([(name, histogram.summary())
+                               for name, histogram in self.stages.items()]),
+            "counters": dict(self.counters),
+            "startup_ms": [[name, seconds * 1000]
+                           for name, seconds in self.startup]
+        }
+
+    def report(self):
+        """
+        Return the statistics as a table for people to read.
+        """
+        lines = ["%-12s %8s %9s %9s %9s %9s" %
+                 ("(us)", "count", "p50", "p99", "p99.9", "max")]
+        rows = [("tick late", self.lateness)]
+        rows += sorted(self.stages.items())
+        for name, histogram in rows:
+            summary = histogram.summary()
+            if summary["count"]:
+                lines.append("%-12s %8d %9d %9d %9d %9d" %
+                             (name, summary["count"], summary["p50"],
+                              summary["p99"], summary["p999"],
+                              summary["max"]))
+        lines.append("")
+        for name in sorted(self.counters):
+            lines.append("%-12s %8d" % (name, self.counters[name]))
+        if self.startup:
+            lines.append("")
+            lines.append(self.startup_report())
+        return "\n".join(lines)
+
+    def dump(self, path):
+        """
+        Write the statistics to path as JSON, replacing whatever's there.
+        """
+        try:
+            write_atomic(path, json.dumps(self.summary(), indent=2,
+                                          sort_keys=True).encode("utf-8"))
+        except (IOError, OSError):
+            pass
+
+class ClockScheduler(object):
     """
-    try:
-        # Try to just find the font in PWD
-        return font.Font(font_name, font_size)
-    except IOError:
-        # If that failed, try it with .ttf appended
-        if not font_name.endswith(".ttf"):
-            try:
-                return font.Font(font_name+".ttf", font_size)
-            except IOError:
-                pass
-                
-    # If that failed, try to find it in system fonts
-    filename = font.match_font(font_name)
-    if filename is not None:
-        return font.Font(filename, font_size)
-    else:
-        # If all else fails, panic and use "Sans" as a last resort
-        return font.SysFont("Sans", font_size)
+    Wakes any number of clocks from a single timer, armed to fire just after
+    the soonest moment any of their displays changes.
+    """
+    def __init__(self, owner):
+        # Each clock, mapped to the monotonic time it next needs a redraw,
+        # or None if it doesn't
+        self.due = {}
 
-# A bunch of default settings
-# TODO: Replace with loading options from a config file
-defaults = {
-    "hr": 0,
-    "min": 1,
-    "sec": 0,
-    "clockcolor": (255, 255, 255),
-    "bgcolor": (255, 0, 255),
-    "font": "Sans",
-    "size": 256,
-    "mask": True,
-    "aot": False,
-    "countup": False
-}
+        # When the timer is armed to fire, slack and all, so lateness is
+        # only what the timer adds on top
+        self.deadline = None
 
-if __name__ == '__main__':
-    # Initialize pygame's font module
-    font.init()
+        self.timer = wx.Timer(owner, -1)
+        owner.Bind(wx.EVT_TIMER, self.OnTimer, self.timer)
 
-    # Stand up the wxPython app and display our control frame
-    app = wx.App()
-    control = ControlFrame()
-    control.Show()
-    app.MainLoop()
+    def Schedule(self, clock):
+        """
+        Note when clock next needs waking, and re-arm if that's sooner than
+        anything else.
+        """
+        self.due[clock] = self.next_due(clock, monotonic())
+        self.Arm()
+
+    def Remove(self, clock):
+        self.due.pop(clock, None)
+        self.Arm()
+
+    def next_due(self, clock, now):
+        delay = clock.TickDelay(now)
+        if delay is None:
+            return None
+        return now + delay
+
+    def Arm(self):
+        due = [when for when in self.due.values() if when is not None]
+        if not due:
+            self.timer.Stop()
+            return
+
+        now = monotonic()
+        delay = max(min(due) - now, 0)
+        ms = int(math.ceil(delay * 1000)) + TIMER_SLACK_MS
+        self.deadline = now + ms / 1000.0
+        self.timer.Start(ms, wx.TIMER_ONE_SHOT)
+
+    def OnTimer(self, evt):
+        now = monotonic()
+        for clock, when in list(self.due.items()):
+            if when is not None and when <= now:
+                stats.late(max(now - self.deadline, 0))
+                clock.Tick()
+                self.due[clock] = self.next_due(clock, monotonic())
+        self.Arm()
+
+class ClockEngine(object):
+    """
+    Time keeping for a clock. Rather than counting ticks, stores the time on
+    the clock as of an anchor on the monotonic clock, and works out the
+    current time from how long it has been since then.
+    """
+    def __init__(self, sec=0, countup=False):
+        # Seconds on the clock as of self.anchor
+        self.base = sec
+        # Monotonic time we last started running from, or None when paused,
+        # and the wall clock time that corresponds to it
+        self.anchor = None
+        self.wall_anchor = None
+        self.countup = countup
+
+    def running(self):
+        return self.anchor is not None
+
+    def value(self, now=None):
+        """
+        Return the time on the clock in (fractional) seconds.
+        """
+        if self.anchor is None:
+            return self.base
+
+        if now is None:
+            now = monotonic()
+
+        if self.countup:
+            return self.base + (now - self.anchor)
+        else:
+            return max(self.base - (now - self.anchor), 0)
+
+    def ticks(self, now=None, scale=1):
+        """
+        Return the time the clock should show, as a whole number of units of
+        1/scale seconds. Counting down rounds up, so a clock set to 60 shows
+        60 for its first second.
+        """
+        value = self.value(now) * scale
+        if self.countup:
+            return int(math.floor(value))
+        else:
+            return int(math.ceil(value))
+
+    def display(self, now=None):
+        """
+        Return the whole number of seconds the clock should show.
+        """
+        return self.ticks(now)
+
+    def next_change(self, now=None, scale=1):
+        """
+        Return the number of seconds until ticks() with the given scale next
+        changes, or None if it won't change while nothing is touched.
+        """
+        if self.anchor is None:
+            return None
+
+        value = self.value(now) * scale
+        if self.countup:
+            return (math.floor(value) + 1 - value) / scale
+        elif value <= 0:
+            return None
+        else:
+            return (value - (math.ceil(value) - 1)) / scale
+
+    def upcoming(self, count):
+        """
+        Return the next count values display() will take while running, or
+        as many as there are before a countdown hits zero.
+        """
+        shown = self.display()
+        step = 1 if self.countup else -1
+        values = []
+        for i in range(1, count + 1):
+            if shown + step * i < 0:
+                break
+            values.append(shown + step * i)
+        return values
+
+    def rebase(self, now=None):
+        """
+        Fold the time run since our anchor into self.base.
+        """
+        if now is None:
+            now = monotonic()
+        self.base = self.value(now)
+        if self.anchor is not None:
+            self.set_anchor(now)
+
+    def set_anchor(self, now):
+        """
+        Anchor the clock at monotonic time now, or pause it if now is None,
+        noting the wall clock time to match for anyone who can't read our
+        monotonic clock.
+        """
+        self.anchor = now
+        self.wall_anchor = None
+        if now is not None:
+            self.wall_anchor = time.time() - (monotonic() - now)
+
+    def set(self, sec):
+        self.base = sec
+        if self.anchor is not None:
+            self.set_anchor(monotonic())
+
+    def set_countup(self, countup):
+        self.rebase()
+        self.countup = countup
+
+    def start(self):
+        if self.anchor is None:
+            self.set_anchor(monotonic())
+
+    def pause(self):
+        if self.anchor is not None:
+            self.rebase()
+            self.set_anchor(None)
+
+class GlyphAtlas(object):
+    """
+    Every character the clock can display, rendered once for a given font and
+    pair of colors. Frames are built by blitting these glyphs into fixed-width
+    cells rather than asking the font to rasterize the whole string each tick.
+
+    Glyphs are 8-bit, their pixels indexing a palette that ramps from the
+    background color to the text color, so frames built from them take a
+    byte a pixel. They're colored in from the font's glyphs, as rasterized by
+    get_glyphs, by that palette alone.
+    """
+    chars = "0123456789:."
+
+    def __init__(self, glyphs, color, bgcolor, smooth=False):
+        self.color = color
+        self.bgcolor = bgcolor
+        self.glyphs = {}
+
+        # Whether glyphs have smooth edges, and how much of each pixel each
+        # glyph covers, as NumPy arrays built on first use
+        self.smooth = smooth
+        self.coverage = {}
+
+        # wx.Bitmaps of each glyph, and wx.Regions covering each glyph's
+        # pixels, built on first use
+        self.bitmaps = {}
+        self.regions = {}
+
+        # Each glyph gets its own copy, so as not to color in anyone else's
+        self.palette = color_ramp(color, bgcolor)
+        for char in self.chars:
+            glyph = glyphs[char].copy()
+            glyph.set_palette(self.palette)
+            self.glyphs[char] = glyph
+
+        # Every digit gets the advance of the widest one, so the clock doesn't
+        # jitter side to side as the digits change
+        self.digit_width = max([self.glyphs[char].get_width()
+                                for char in "0123456789"])
+        self.height = max([glyph.get_height()
+                           for glyph in self.glyphs.values()])
+
+    def cell_width(self, char):
+        if char.isdigit():
+            return self.digit_width
+        return self.glyphs[char].get_width()
+
+    def glyph_offset(self, char):
+        """
+        Return how far into its cell char's glyph is drawn. Narrow glyphs are
+        centred in their cell.
+        """
+        return (self.cell_width(char) - self.glyphs[char].get_width()) // 2
+
+    def text_size(self, text):
+        return (sum([self.cell_width(char) for char in text]), self.height)
+
+    def layout(self, text, x=0):
+        """
+        Return a (char, x) pair giving the left edge of each character's cell.
+        """
+        cells = []
+        for char in text:
+            cells.append((char, x))
+            x += self.cell_width(char)
+        return cells
+
+    def blit(self, surf, text, x=0):
+        """
+        Blit text onto surf, starting at horizontal offset x.
+        """
+        for char, cell_x in self.layout(text, x):
+            surf.blit(self.glyphs[char], (cell_x + self.glyph_offset(char), 0))
+
+    def blit_coverage(self, alpha, text, x=0, y=0):
+        """
+        Copy the coverage of text, starting at offset (x, y), into alpha: a
+        NumPy array indexed [x, y], like pygame's surfarrays. Glyphs are
+        cropped to fit.
+        """
+        width, height = alpha.shape
+        for char, cell_x in self.layout(text, x):
+            glyph = self.glyph_coverage(char)
+            left = cell_x + self.glyph_offset(char)
+            glyph_left = max(-left, 0)
+            glyph_top = max(-y, 0)
+            right = min(left + glyph.shape[0], width)
+            bottom = min(y + glyph.shape[1], height)
+            if right <= left + glyph_left or bottom <= y + glyph_top:
+                continue
+            alpha[left + glyph_left:right, y + glyph_top:bottom] = \
+                glyph[glyph_left:right - left, glyph_top:bottom - y]
+
+    def glyph_coverage(self, char):
+        """
+        Return how much of each pixel char's glyph covers, as a NumPy array
+        indexed [x, y]. A glyph's pixels are its coverage.
+        """
+        if char not in self.coverage:
+            self.coverage[char] = surfarray.array2d(
+                self.glyphs[char]).astype(numpy.uint8)
+        return self.coverage[char]
+
+    def glyph_bitmap(self, char):
+        """
+        Return char's glyph as a wx.Bitmap.
+        """
+        if char not in self.bitmaps:
+            glyph = self.glyphs[char]
+            width, height = glyph.get_size()
+            self.bitmaps[char] = wx.BitmapFromBuffer(
+                width, height, image.tostring(glyph, "RGB"))
+        return self.bitmaps[char]
+
+    def glyph_region(self, char):
+        """
+        Return a wx.Region covering the non-background pixels of char's glyph.
+        """
+        if char not in self.regions:
+            self.regions[char] = wx.RegionFromBitmapColour(
+                self.glyph_bitmap(char), wx.Colour(*self.bgcolor))
+        return self.regions[char]
+
+class FrameCanvas(object):
+    """
+    Fits a clock's frames to a fixed size and pixel format, for outputs whose
+    readers need every frame alike. The size is the clock's when first drawn,
+    unless given.
+    """
+    def __init__(self, size=None, fmt="rgb"):
+        self.size = size
+        self.fmt = fmt
+        self.canvas = None
+        self.alpha = None
+
+    def render(self, clock, text):
+        """
+        Return clock's current frame, showing text, as a string of RGB or
+        RGBA pixels.
+        """
+        surf = clock.bgsurf
+        if self.size is None:
+            self.size = surf.get_size()
+
+        if self.canvas is None:
+            self.canvas = surface.Surface(self.size)
+            if self.fmt == "rgba":
+                self.alpha = surface.Surface(self.size, SRCALPHA, 32)
+
+        # Centre the frame on our canvas, cropping it if it's too big
+        self.canvas.fill(clock.bgcolor)
+        self.canvas.blit(surf, ((self.size[0] - surf.get_width()) // 2,
+                                (self.size[1] - surf.get_height()) // 2))
+
+        if self.alpha is None:
+            return image.tostring(self.canvas, "RGB")
+
+        # Make the background transparent if the clock's is masked out,
+        # with smooth edges if we can
+        atlas = None
+        if clock.mask:
+            atlas = get_atlas(clock.text_font, clock.draw_size, clock.color,
+                              clock.bgcolor, defaults["smooth"])
+        if atlas is not None and atlas.smooth:
+            compose_alpha(self.alpha, atlas, text)
+        else:
+            self.canvas.set_colorkey(clock.bgcolor if clock.mask else None)
+            self.alpha.fill((0, 0, 0, 0))
+            self.alpha.blit(self.canvas, (0, 0))
+        return image.tostring(self.alpha, "RGBA")
+
+class FrameStreamer(object):
+    """
+    Streams a clock's frames as raw RGB or RGBA video, at a fixed frame rate
+    and size, to a file, named pipe, or stdout ("-"), for ffmpeg and the like
+    to read with -f rawvideo.
+
+    The GUI thread only ever hands over its latest frame. A pacing thread
+    queues that frame every 1/fps seconds and a writer thread drains the
+    queue, so a slow reader never stalls the clock. If the reader falls
+    behind far enough to fill the queue, the oldest queued frame is dropped.
+    """
+    def __init__(self, path, fps, size=None, fmt="rgb", queue_size=None):
+        self.path = path
+        self.period = 1.0 / fps
+        self.canvas = FrameCanvas(size, fmt)
+
+        self.latest = None
+        self.frames = queue.Queue(queue_size or STREAM_QUEUE_SIZE)
+        self.closed = threading.Event()
+
+        self.written = 0
+        self.dropped = 0
+        self.reported = 0
+
+        for target in (self.pace, self.write):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def publish(self, clock, text):
+        """
+        Take a copy of clock's current frame, fitted to our frame size, as the
+        frame to stream from now on. Called from the GUI thread.
+        """
+        self.latest = self.canvas.render(clock, text)
+
+    def pace(self):
+        next_frame = monotonic()
+        while not self.closed.is_set():
+            next_frame += self.period
+            delay = next_frame - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -self.period:
+                # We've fallen well behind, so don't try to catch up in a burst
+                next_frame = monotonic()
+
+            frame = self.latest
+            if frame is None:
+                continue
+
+            try:
+                self.frames.put_nowait(frame)
+            except queue.Full:
+                try:
+                    self.frames.get_nowait()
+                except queue.Empty:
+                    pass
+                self.frames.put_nowait(frame)
+                self.dropped += 1
+
+            if self.dropped - self.reported >= STREAM_REPORT_DROPS:
+                self.report()
+
+    def write(self):
+        # Opening a named pipe blocks until something opens the other end
+        if self.path == "-":
+            out = getattr(sys.stdout, "buffer", sys.stdout)
+        else:
+            out = open(self.path, "wb")
+
+        try:
+            while not self.closed.is_set():
+                try:
+                    frame = self.frames.get(True, 0.5)
+                except queue.Empty:
+                    continue
+                out.write(frame)
+                out.flush()
+                self.written += 1
+        except IOError:
+            # The reader has gone away; nothing more we can do
+            self.closed.set()
+        finally:
+            if out is not getattr(sys.stdout, "buffer", sys.stdout):
+                out.close()
+
+    def report(self):
+        self.reported = self.dropped
+        sys.stderr.write("occult: streamed %d frames to %s, dropped %d\n" %
+                         (self.written, self.path, self.dropped))
+
+    def close(self):
+        self.closed.set()
+        self.report()
+
+class FrameRing(object):
+    """
+    Publishes a clock's frames into a ring of slots in a memory mapped file,
+    such as one in /dev/shm, for readers on the same machine to read in place.
+
+    The file starts with a header: RING_HEADER, giving the magic string
+    "OCCR", layout version, number of slots, bytes per slot, offset of the
+    first slot, and the sequence number of the latest complete frame. Frame
+    n sits in slot n % slots, which starts with SLOT_HEADER: a write counter,
+    the frame's sequence number, width, height, stride, format (1 for RGB, 2
+    for RGBA), and wall clock timestamp, followed at SLOT_DATA by its pixels.
+
+    The writer never waits for readers. It makes the slot's write counter odd
+    while writing and even once done, so a reader that sees the counter odd,
+    or changed after copying the frame out, knows it raced the writer and
+    should read the latest frame again. occult_ring.py is a reader.
+    """
+    def __init__(self, path, size=None, fmt="rgb", slots=None):
+        self.path = path
+        self.slots = slots or SHM_SLOTS
+        self.canvas = FrameCanvas(size, fmt)
+        self.format = fmt == "rgba" and 2 or 1
+        self.bpp = fmt == "rgba" and 4 or 3
+        self.seq = 0
+        self.map = None
+        self.file = None
+
+    def open(self, size):
+        stride = size[0] * self.bpp
+        self.slot_size = SLOT_DATA + stride * size[1]
+        length = SHM_HEADER + self.slot_size * self.slots
+
+        self.file = open(self.path, "w+b")
+        self.file.truncate(length)
+        self.map = mmap.mmap(self.file.fileno(), length)
+        RING_HEADER.pack_into(self.map, 0, b"OCCR", 1, self.slots,
+                              self.slot_size, SHM_HEADER, 0)
+
+    def publish(self, clock, text):
+        """
+        Write clock's current frame into the next slot. Called from the GUI
+        thread.
+        """
+        frame = self.canvas.render(clock, text)
+        if self.map is None:
+            self.open(self.canvas.size)
+
+        self.seq += 1
+        width, height = self.canvas.size
+        offset = SHM_HEADER + (self.seq % self.slots) * self.slot_size
+        count = struct.unpack_from("<Q", self.map, offset)[0]
+
+        struct.pack_into("<Q", self.map, offset, count + 1)
+        SLOT_HEADER.pack_into(self.map, offset, count + 1, self.seq, width,
+                              height, width * self.bpp, self.format,
+                              time.time())
+        self.map[offset + SLOT_DATA:offset + SLOT_DATA + len(frame)] = frame
+        struct.pack_into("<Q", self.map, offset, count + 2)
+
+        # Only now is the frame there to be read
+        struct.pack_into("<Q", self.map, RING_LATEST, self.seq)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+            self.map = None
+
+class TextFileWriter(object):
+    """
+    Writes clocks' displayed times to text files, for OBS text sources and
+    the like to read. A file is only rewritten when its text changes, and
+    always atomically, so readers never see half a time. Writes queued by
+    every clock in one pass of the event loop go out together at its end.
+    """
+    def __init__(self):
+        # Text waiting to be written, and what each file last had written,
+        # keyed by path
+        self.pending = {}
+        self.written = {}
+        self.flush_pending = False
+
+    def write(self, path, text):
+        if self.written.get(path) == text:
+            self.pending.pop(path, None)
+            return
+
+        self.pending[path] = text
+        if not self.flush_pending:
+            self.flush_pending = True
+            wx.CallAfter(self.flush)
+
+    def flush(self):
+        self.flush_pending = False
+        pending = self.pending
+        self.pending = {}
+        for path, text in pending.items():
+            try:
+                write_atomic(path, text.encode("utf-8"))
+            except (IOError, OSError):
+                error = sys.exc_info()[1]
+                sys.stderr.write("occult: couldn't write %s: %s\n" %
+                                 (path, error))
+                continue
+            self.written[path] = text
+        stats.count("text_writes", len(pending))
+
+class FramePrerenderer(object):
+    """
+    Renders a clock's upcoming frames on a worker thread, so that when the
+    display changes the GUI thread need only swap in a finished frame.
+
+    Frames are keyed by the atlas, size, and background they were composed
+    with, and only handed out for an exact match. Ready frames are kept in a
+    small pool of reused buffers, and frames too big to be worth the memory
+    aren't rendered ahead at all.
+    """
+    def __init__(self, depth):
+        self.depth = depth
+        self.cond = threading.Condition()
+
+        # Frames to render, as (generation, key, text), and those rendered,
+        # as text mapped to (key, buffer, surface)
+        self.jobs = []
+        self.ready = {}
+
+        # Buffers free for reuse
+        self.spare = []
+
+        # Bumped on discard, so frames in progress when it happens are dropped
+        self.generation = 0
+        self.closed = False
+
+        thread = threading.Thread(target=self.work)
+        thread.daemon = True
+        thread.start()
+
+    def request(self, atlas, size, bgcolor, texts):
+        """
+        Ask for the frames showing each of texts to be rendered, dropping any
+        ready frames that aren't among them.
+        """
+        key = (atlas, tuple(size), tuple(bgcolor))
+        texts = texts[:max(PRERENDER_MAX_BYTES // (size[0] * size[1]), 0)]
+        with self.cond:
+            for text in list(self.ready):
+                if text not in texts or self.ready[text][0] != key:
+                    self.recycle(self.ready.pop(text)[1])
+            self.jobs = [(self.generation, key, text) for text in texts
+                         if text not in self.ready]
+            self.cond.notify()
+
+    def take(self, atlas, size, bgcolor, text):
+        """
+        Return the (buffer, surface) of the ready frame showing text, if we
+        have one matching the given atlas, size, and background.
+        """
+        key = (atlas, tuple(size), tuple(bgcolor))
+        with self.cond:
+            frame = self.ready.pop(text, None)
+            if frame is None:
+                return None
+            if frame[0] != key:
+                self.recycle(frame[1])
+                return None
+        return frame[1], frame[2]
+
+    def recycle(self, buf):
+        """
+        Give a frame buffer we, or the clock, are done with back to the pool.
+        """
+        with self.cond:
+            if buf is not None and len(self.spare) <= self.depth:
+                self.spare.append(buf)
+
+    def discard(self):
+        """
+        Throw away everything ready or in progress.
+        """
+        with self.cond:
+            self.generation += 1
+            self.jobs = []
+            for key, buf, surf in self.ready.values():
+                self.recycle(buf)
+            self.ready = {}
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.jobs and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+
+                generation, key, text = self.jobs.pop(0)
+                atlas, size, bgcolor = key
+                length = size[0] * size[1]
+                buf = None
+                for spare in self.spare:
+                    if len(spare) == length:
+                        buf = spare
+                        self.spare.remove(spare)
+                        break
+                # Buffers of the wrong size are no use to anyone any more
+                if buf is None:
+                    self.spare = []
+
+            if buf is None:
+                buf = bytearray(length)
+            surf = image.frombuffer(buf, size, "P")
+            surf.set_palette(atlas.palette)
+            compose_frame(surf, atlas, text, bgcolor)
+
+            with self.cond:
+                if generation == self.generation:
+                    self.ready[text] = (key, buf, surf)
+                else:
+                    self.recycle(buf)
+
+class StateServer(object):
+    """
+    Publishes clock state to browser sources and anything else on the
+    network: as JSON over plain HTTP at /state, and as events pushed over a
+    WebSocket at /ws. Subscribers are sent the full state of every clock when
+    they connect, then only the fields that change, each time they change.
+
+    Serves from a select() loop on its own thread, so the wx main loop only
+    ever has to encode a change once and hand it over.
+    """
+    def __init__(self, host, port):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(16)
+        self.listener.setblocking(0)
+
+        # Written to from publish() to wake the serving thread
+        self.wake_r, self.wake_w = make_socketpair()
+
+        # The state of each clock, keyed by clock ID as a string
+        self.lock = threading.Lock()
+        self.state = {}
+        self.snapshot()
+        self.pending = []
+        self.closed = False
+
+        # Connected sockets, mapped to their StateConnections
+        self.conns = {}
+
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def publish(self, clock_id, state):
+        """
+        Note a new state for a clock, and queue whichever fields changed to go
+        out to WebSocket subscribers. Called from the GUI thread.
+        """
+        clock_id = str(clock_id)
+        with self.lock:
+            old = self.state.get(clock_id, {})
+            changes = dict([(key, value) for key, value in state.items()
+                            if old.get(key, None) != value or key not in old])
+            if not changes:
+                return
+
+            self.state[clock_id] = dict(state)
+            self.snapshot()
+
+            # Encode once here, for every subscriber, rather than per client
+            changes["type"] = "change"
+            changes["clock"] = clock_id
+            changes["server_time"] = time.time()
+            self.pending.append(websocket_frame(json.dumps(changes)))
+        self.wake()
+
+    def snapshot(self):
+        """
+        Re-encode the full state served at /state, but for the time it's
+        served at. Call with self.lock held.
+        """
+        self.state_json = json.dumps(self.state).encode("utf-8")
+
+    def state_body(self):
+        """
+        Return the full state served at /state, as of now. Call with
+        self.lock held.
+        """
+        return (('{"server_time": %r, "clocks": ' % time.time()).encode("utf-8")
+                + self.state_json + b"}")
+
+    def unpublish(self, clock_id):
+        """
+        Forget a clock that has gone away, and tell subscribers so.
+        """
+        clock_id = str(clock_id)
+        with self.lock:
+            if self.state.pop(clock_id, None) is None:
+                return
+            self.snapshot()
+            self.pending.append(websocket_frame(json.dumps(
+                {"type": "remove", "clock": clock_id,
+                 "server_time": time.time()})))
+        self.wake()
+
+    def wake(self):
+        try:
+            self.wake_w.send(b"\0")
+        except socket.error:
+            pass
+
+    def close(self):
+        self.closed = True
+        self.wake()
+
+    def serve(self):
+        while not self.closed:
+            writers = [sock for sock, conn in self.conns.items() if conn.out]
+            readers = [self.listener, self.wake_r] + list(self.conns)
+            readable, writable, broken = select.select(readers, writers,
+                                                       readers)
+
+            for sock in readable:
+                if sock is self.listener:
+                    self.accept()
+                elif sock is self.wake_r:
+                    self.wake_r.recv(4096)
+                    self.fan_out()
+                elif sock in self.conns:
+                    # Unless fan_out just cut it off
+                    self.read(sock)
+
+            for sock in writable:
+                if sock in self.conns:
+                    self.flush(sock)
+
+            for sock in broken:
+                if sock in self.conns:
+                    self.drop(sock)
+
+        for sock in list(self.conns):
+            self.drop(sock)
+        self.listener.close()
+
+    def accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        self.conns[sock] = StateConnection()
+
+    def fan_out(self):
+        with self.lock:
+            pending = b"".join(self.pending)
+            self.pending = []
+
+        for sock, conn in list(self.conns.items()):
+            if conn.websocket:
+                conn.out += pending
+                # Cut off anyone so far behind they'll never catch up
+                if len(conn.out) > STATE_SERVER_MAX_BACKLOG:
+                    self.drop(sock)
+
+    def read(self, sock):
+        conn = self.conns[sock]
+        try:
+            data = sock.recv(4096)
+        except socket.error:
+            data = b""
+        if not data:
+            self.drop(sock)
+            return
+        conn.inbuf += data
+
+        if conn.websocket:
+            self.read_websocket(sock, conn)
+            if len(conn.inbuf) > WEBSOCKET_MAX_FRAME and sock in self.conns:
+                self.drop(sock)
+        elif b"\r\n\r\n" in conn.inbuf:
+            self.read_request(sock, conn)
+        elif len(conn.inbuf) > 8192:
+            self.drop(sock)
+
+    def read_request(self, sock, conn):
+        head = bytes(conn.inbuf).split(b"\r\n\r\n", 1)[0].decode("latin-1")
+        del conn.inbuf[:]
+
+        lines = head.split("\r\n")
+        try:
+            method, path = lines[0].split(" ")[:2]
+        except ValueError:
+            method, path = "", ""
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+
+        if method != "GET":
+            self.respond(conn, "405 Method Not Allowed", b"")
+        elif path == "/ws" and "sec-websocket-key" in headers:
+            key = headers["sec-websocket-key"] + WEBSOCKET_GUID
+            accept = base64.b64encode(hashlib.sha1(key.encode("latin-1"))
+                                      .digest()).decode("latin-1")
+            conn.out += ("HTTP/1.1 101 Switching Protocols\r\n"
+                         "Upgrade: websocket\r\n"
+                         "Connection: Upgrade\r\n"
+                         "Sec-WebSocket-Accept: %s\r\n\r\n" %
+                         accept).encode("latin-1")
+            conn.websocket = True
+
+            # Start new subscribers off with everything
+            with self.lock:
+                state = {"type": "state", "clocks": self.state,
+                         "server_time": time.time()}
+                conn.out += websocket_frame(json.dumps(state))
+        elif path == "/state":
+            with self.lock:
+                body = self.state_body()
+            self.respond(conn, "200 OK", body, "application/json")
+        else:
+            self.respond(conn, "404 Not Found", b"")
+
+    def respond(self, conn, status, body, content_type="text/plain"):
+        conn.out += ("HTTP/1.1 %s\r\n"
+                     "Content-Type: %s\r\n"
+                     "Content-Length: %d\r\n"
+                     "Access-Control-Allow-Origin: *\r\n"
+                     "Cache-Control: no-cache\r\n"
+                     "Connection: close\r\n\r\n" %
+                     (status, content_type, len(body))).encode("latin-1")
+        conn.out += body
+        conn.closing = True
+
+    def read_websocket(self, sock, conn):
+        """
+        Consume frames from a subscriber. We've nothing to hear from them, so
+        all that matters is answering pings and noticing goodbyes.
+        """
+        while len(conn.inbuf) >= 2:
+            opcode = conn.inbuf[0] & 0x0f
+            masked = conn.inbuf[1] & 0x80
+            length = conn.inbuf[1] & 0x7f
+            start = 2
+            if length == 126:
+                start = 4
+            elif length == 127:
+                start = 10
+            if len(conn.inbuf) < start:
+                return
+            if length == 126:
+                length = struct.unpack("!H", bytes(conn.inbuf[2:4]))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", bytes(conn.inbuf[2:10]))[0]
+
+            # Subscribers only ever close or ping, so a frame claiming to be
+            # bigger is up to no good, and won't be buffered
+            if length > WEBSOCKET_MAX_FRAME:
+                self.drop(sock)
+                return
+
+            mask = b""
+            if masked:
+                mask = conn.inbuf[start:start + 4]
+                start += 4
+            if len(conn.inbuf) < start + length:
+                return
+
+            payload = conn.inbuf[start:start + length]
+            del conn.inbuf[:start + length]
+            if masked:
+                payload = bytearray([byte ^ mask[i % 4]
+                                     for i, byte in enumerate(payload)])
+
+            if opcode == 0x8:
+                conn.out += websocket_frame(b"", 0x8)
+                conn.closing = True
+                return
+            elif opcode == 0x9:
+                conn.out += websocket_frame(bytes(payload), 0xa)
+
+    def flush(self, sock):
+        conn = self.conns[sock]
+        try:
+            sent = sock.send(bytes(conn.out))
+        except socket.error:
+            self.drop(sock)
+            return
+        del conn.out[:sent]
+        if conn.closing and not conn.out:
+            self.drop(sock)
+
+    def drop(self, sock):
+        del self.conns[sock]
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+class ControlServer(object):
+    """
+    Takes commands for the clocks from other processes over a Unix domain
+    socket, so they can be started, paused, and set without going near the
+    control panel. occult_ctl.py is a client.
+
+    Requests and replies are single lines of JSON. A request is a list of
+    commands, all applied together on the GUI thread in one pass of its
+    event loop, and the reply is a list of their results in the same order.
+    Serves from a select() loop on its own thread that sleeps until there's
+    something to read or write.
+    """
+    def __init__(self, path, control):
+        self.path = path
+        self.control = control
+
+        # Clear out a socket left by an occult that's gone, but not one that's
+        # still running, nor anything that isn't a socket at all
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise ValueError("%s exists and isn't a socket" % path)
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                os.remove(path)
+            else:
+                raise ValueError("Another occult is listening on %s" % path)
+            finally:
+                probe.close()
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(16)
+        self.listener.setblocking(0)
+
+        # Written to when replies are ready, to wake the serving thread
+        self.wake_r, self.wake_w = make_socketpair()
+        self.lock = threading.Lock()
+        self.replies = []
+        self.closed = False
+
+        # Connected sockets, mapped to their StateConnections
+        self.conns = {}
+
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while not self.closed:
+            writers = [sock for sock, conn in self.conns.items() if conn.out]
+            readers = [self.listener, self.wake_r] + list(self.conns)
+            readable, writable, broken = select.select(readers, writers,
+                                                       readers)
+
+            for sock in readable:
+                if sock is self.listener:
+                    self.accept()
+                elif sock is self.wake_r:
+                    self.wake_r.recv(4096)
+                    self.queue_replies()
+                elif sock in self.conns:
+                    self.read(sock)
+
+            for sock in writable:
+                if sock in self.conns:
+                    self.flush(sock)
+
+            for sock in broken:
+                if sock in self.conns:
+                    self.drop(sock)
+
+        for sock in list(self.conns):
+            self.drop(sock)
+        self.listener.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        self.conns[sock] = StateConnection()
+
+    def read(self, sock):
+        conn = self.conns[sock]
+        try:
+            data = sock.recv(65536)
+        except socket.error:
+            data = b""
+        if not data:
+            self.drop(sock)
+            return
+        conn.inbuf += data
+
+        while b"\n" in conn.inbuf:
+            end = conn.inbuf.index(b"\n")
+            line = bytes(conn.inbuf[:end])
+            del conn.inbuf[:end + 1]
+            try:
+                commands = json.loads(line.decode("utf-8"))
+                if not isinstance(commands, list):
+                    commands = [commands]
+            except ValueError:
+                conn.out += json.dumps([{"ok": False,
+                                         "error": "Bad JSON"}]).encode(
+                                             "utf-8") + b"\n"
+                continue
+            wx.CallAfter(self.run, sock, commands)
+
+        if len(conn.inbuf) > STATE_SERVER_MAX_BACKLOG:
+            self.drop(sock)
+
+    def run(self, sock, commands):
+        """
+        Apply a request's commands and hand back the reply. Called on the GUI
+        thread.
+        """
+        # Whatever goes wrong, the client is waiting on a reply
+        try:
+            reply = json.dumps(self.control.RunCommands(commands))
+        except Exception:
+            error = "%s: %s" % (sys.exc_info()[0].__name__, sys.exc_info()[1])
+            sys.stderr.write("occult: control command failed: %s\n" % error)
+            reply = json.dumps([{"ok": False, "error": error}])
+        reply = reply.encode("utf-8") + b"\n"
+        with self.lock:
+            self.replies.append((sock, reply))
+        try:
+            self.wake_w.send(b"\0")
+        except socket.error:
+            pass
+
+    def queue_replies(self):
+        with self.lock:
+            replies = self.replies
+            self.replies = []
+        for sock, reply in replies:
+            # The client may have hung up while we were busy
+            if sock in self.conns:
+                self.conns[sock].out += reply
+
+    def flush(self, sock):
+        conn = self.conns[sock]
+        try:
+            sent = sock.send(bytes(conn.out))
+        except socket.error:
+            self.drop(sock)
+            return
+        del conn.out[:sent]
+
+    def drop(self, sock):
+        del self.conns[sock]
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+    def close(self):
+        self.closed = True
+        try:
+            self.wake_w.send(b"\0")
+        except socket.error:
+            pass
+
+class StateJournal(object):
+    """
+    An append-only journal of every clock's state, so that if occult is
+    closed, or dies mid-show, its clocks pick up where they left off.
+
+    Each record is a line of JSON holding a clock's whole state, written
+    whenever its options change or it starts or pauses. Running clocks are
+    described by their monotonic and wall clock anchors, so nothing need be
+    written as they tick. A writer thread appends records in batches,
+    syncing them to disk at most once every JOURNAL_SYNC_INTERVAL seconds,
+    and compacts the journal down to each clock's latest record once it has
+    grown past JOURNAL_COMPACT_RECORDS.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.cond = threading.Condition()
+        self.pending = []
+        self.closing = threading.Event()
+
+        # The latest state of each clock, keyed by clock ID as a string,
+        # starting from what's already in the journal
+        self.states = {}
+        self.load()
+        self.compact()
+        self.out = open(path, "ab")
+
+        self.thread = threading.Thread(target=self.work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def load(self):
+        """
+        Replay the journal on disk into self.states. A record torn by a
+        crash, which can only be the last, is ignored.
+        """
+        try:
+            lines = open(self.path, "rb").read().split(b"\n")
+        except (IOError, OSError):
+            return
+
+        for line in lines:
+            try:
+                self.apply(json.loads(line.decode("utf-8")))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                break
+
+    def apply(self, record):
+        clock_id = str(record["clock"])
+        if record.get("closed"):
+            self.states.pop(clock_id, None)
+        else:
+            self.states[clock_id] = dict(record["state"])
+
+    def replay(self):
+        """
+        Return the latest state of every clock in the journal.
+        """
+        with self.cond:
+            return dict(self.states)
+
+    def record(self, clock_id, state):
+        self.append({"clock": clock_id, "state": state})
+
+    def forget(self, clock_id):
+        """
+        Note that a clock has been closed for good, so isn't brought back.
+        """
+        self.append({"clock": clock_id, "closed": True})
+
+    def append(self, record):
+        with self.cond:
+            self.pending.append(record)
+            self.cond.notify()
+
+    def close(self):
+        """
+        Write out anything pending, and stop.
+        """
+        self.closing.set()
+        with self.cond:
+            self.cond.notify()
+        self.thread.join()
+        self.out.close()
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closing.is_set():
+                    self.cond.wait()
+                pending = self.pending
+                self.pending = []
+
+            if pending:
+                try:
+                    self.write(pending)
+                except (IOError, OSError):
+                    sys.stderr.write("occult: couldn't write journal %s: "
+                                     "%s\n" % (self.path, sys.exc_info()[1]))
+            if self.closing.is_set():
+                return
+
+            # Let records pile up for a while rather than syncing each
+            self.closing.wait(JOURNAL_SYNC_INTERVAL)
+
+    def write(self, records):
+        with self.cond:
+            for record in records:
+                self.apply(record)
+
+        self.out.write(b"".join([json.dumps(record).encode("utf-8") + b"\n"
+                                 for record in records]))
+        self.out.flush()
+        os.fsync(self.out.fileno())
+        self.records += len(records)
+        stats.count("journal_syncs")
+
+        if self.records > JOURNAL_COMPACT_RECORDS:
+            self.out.close()
+            self.compact()
+            self.out = open(self.path, "ab")
+
+    def compact(self):
+        """
+        Rewrite the journal with just the latest record for each clock.
+        """
+        with self.cond:
+            records = [{"clock": clock_id, "state": state}
+                       for clock_id, state in sorted(self.states.items())]
+        write_atomic(self.path, b"".join([json.dumps(record).encode("utf-8") +
+                                          b"\n" for record in records]),
+                     sync=True)
+        self.records = len(records)
+
+class StateConnection(object):
+    """
+    Buffers and status for one client of a StateServer or ControlServer.
+    """
+    def __init__(self):
+        self.inbuf = bytearray()
+        self.out = bytearray()
+        self.websocket = False
+        self.closing = False
+
+class FontCache(object):
+    """
+    Loaded pygame Fonts, keyed by file and size. Memory use is bounded by a
+    rough cost of size squared per font; when over budget, the largest sizes
+    are evicted first, least recently used among equals.
+    """
+    def __init__(self, budget, max_fonts):
+        self.budget = budget
+        self.max_fonts = max_fonts
+        self.fonts = {}
+        # Keys from least to most recently used
+        self.order = []
+        self.cost = 0
+
+    def get(self, key):
+        if key not in self.fonts:
+            return None
+        self.order.remove(key)
+        self.order.append(key)
+        return self.fonts[key]
+
+    def add(self, key, loaded):
+        self.fonts[key] = loaded
+        self.order.append(key)
+        self.cost += key[1] ** 2
+
+        while (len(self.order) > 1 and
+               (self.cost > self.budget or len(self.order) > self.max_fonts)):
+            # Never evict what we've just loaded
+            victim = max(self.order[:-1], key=lambda entry: entry[1])
+            self.order.remove(victim)
+            del self.fonts[victim]
+            self.cost -= victim[1] ** 2
+
+class SurfaceCache(object):
+    """
+    Glyph atlases and glyph sets, bounded by what they cost in bytes rather
+    than how many there are. The budget is the memory limit, read as each
+    entry is added, so cached glyphs count against it like a clock's frames.
+    When over budget, the least recently used are evicted first.
+    """
+    def __init__(self):
+        self.entries = {}
+        # Keys from least to most recently used, and their costs in bytes
+        self.order = []
+        self.costs = {}
+        self.cost = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.order.remove(key)
+        self.order.append(key)
+        return self.entries[key]
+
+    def add(self, key, entry, cost):
+        self.entries[key] = entry
+        self.order.append(key)
+        self.costs[key] = cost
+        self.cost += cost
+
+        budget = defaults["memory_limit"] * 1024 * 1024
+        while len(self.order) > 1 and self.cost > budget:
+            # Never evict what we've just added
+            victim = self.order.pop(0)
+            del self.entries[victim]
+            self.cost -= self.costs.pop(victim)
+
+    def clear(self):
+        self.entries.clear()
+        del self.order[:]
+        self.costs.clear()
+        self.cost = 0
+
+class FontIndex(object):
+    """
+    A map of system font names to font files, kept on disk so we needn't have
+    pygame scan every system font directory each time we start up or change
+    font. An entry is trusted only while the directory its font was found in
+    is unmodified; names that matched nothing, while none of the system font
+    directories or any directory within them are, since fonts are usually
+    installed into a subdirectory of their own.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.fonts = None
+        self.dirs = None
+
+    def load(self):
+        self.fonts = {}
+        self.dirs = {}
+        try:
+            index = json.load(open(cache_path(self.filename)))
+            self.fonts = index["fonts"]
+            self.dirs = index["dirs"]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def save(self):
+        try:
+            write_atomic(cache_path(self.filename),
+                         json.dumps({"fonts": self.fonts,
+                                     "dirs": self.dirs}).encode("utf-8"))
+        except (IOError, OSError):
+            # The index is only a shortcut; we can live without it
+            pass
+
+    def mtime(self, path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def lookup(self, font_name):
+        """
+        Return the path to the system font called font_name, or None.
+        """
+        if self.fonts is None:
+            self.load()
+
+        key = font_name.lower()
+        if key in self.fonts:
+            path = self.fonts[key]
+            if path is None:
+                dirs = font_dir_tree()
+            else:
+                dirs = [os.path.dirname(path)]
+
+            if (path is None or os.path.isfile(path)) and \
+                    all([self.dirs.get(d) == self.mtime(d) for d in dirs]):
+                return path
+
+        path = font.match_font(font_name)
+        self.fonts[key] = path
+        if path is None:
+            dirs = font_dir_tree()
+        else:
+            dirs = [os.path.dirname(path)]
+        for directory in dirs:
+            self.dirs[directory] = self.mtime(directory)
+        self.save()
+        return path
+
+class GlyphCache(object):
+    """
+    Fonts' rasterized glyphs, kept on disk so that a clock restarted in a
+    font and size it's been drawn in before paints its first frame without
+    loading the font at all. Glyphs are palette indices, so one entry serves
+    every color. Entries are keyed by a hash of their font file, so a font
+    that's been updated is rasterized afresh, and only the max_files most
+    recently used are kept.
+
+    Each entry is GLYPH_CACHE_MAGIC, then the width and height of each of
+    GlyphAtlas.chars in turn, then each one's pixels, a byte apiece.
+    """
+    def __init__(self, prefix, max_files, max_bytes):
+        self.prefix = prefix
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+
+        # Font files' hashes, by path, modification time, and size
+        self.hashes = {}
+
+    def font_hash(self, path):
+        stat = os.stat(path)
+        key = (path, stat.st_mtime, stat.st_size)
+        if key not in self.hashes:
+            data = open(path, "rb")
+            try:
+                self.hashes[key] = hashlib.sha1(data.read()).hexdigest()
+            finally:
+                data.close()
+        return self.hashes[key]
+
+    def filename(self, path, font_size, smooth):
+        return cache_path("%s%s-%d-%s" % (self.prefix, self.font_hash(path),
+                                          font_size,
+                                          smooth and "smooth" or "hard"))
+
+    def read_sizes(self, entry):
+        """
+        Read the header of an open entry, and return each glyph's size.
+        """
+        header = entry.read(len(GLYPH_CACHE_MAGIC) +
+                            GLYPH_SIZE.size * len(GlyphAtlas.chars))
+        if not header.startswith(GLYPH_CACHE_MAGIC):
+            raise ValueError("Not a glyph cache entry")
+
+        sizes = {}
+        for i, char in enumerate(GlyphAtlas.chars):
+            sizes[char] = GLYPH_SIZE.unpack_from(
+                header, len(GLYPH_CACHE_MAGIC) + i * GLYPH_SIZE.size)
+        return sizes
+
+    def sizes(self, path, font_size, smooth):
+        """
+        Return the size of each glyph cached for the font file at path,
+        without reading the glyphs themselves, or None if there's no entry.
+        """
+        try:
+            entry = open(self.filename(path, font_size, smooth), "rb")
+            try:
+                return self.read_sizes(entry)
+            finally:
+                entry.close()
+        except (IOError, OSError, ValueError, struct.error):
+            return None
+
+    def load(self, path, font_size, smooth):
+        """
+        Return the glyphs cached for the font file at path, as get_glyphs
+        would, or None if there's no entry.
+        """
+        try:
+            filename = self.filename(path, font_size, smooth)
+            entry = open(filename, "rb")
+            try:
+                glyphs = {}
+                sizes = self.read_sizes(entry)
+                ramp = color_ramp((255, 255, 255), (0, 0, 0))
+                for char in GlyphAtlas.chars:
+                    width, height = sizes[char]
+                    data = entry.read(width * height)
+                    if len(data) != width * height:
+                        raise ValueError("Glyph cache entry is truncated")
+                    glyph = image.fromstring(data, (width, height), "P")
+                    glyph.set_palette(ramp)
+                    glyphs[char] = glyph
+            finally:
+                entry.close()
+
+            # Mark the entry used, so it's the last to be pruned
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError, struct.error):
+            return None
+        return glyphs
+
+    def save(self, path, font_size, smooth, glyphs):
+        parts = [GLYPH_CACHE_MAGIC]
+        for char in GlyphAtlas.chars:
+            parts.append(GLYPH_SIZE.pack(*glyphs[char].get_size()))
+        for char in GlyphAtlas.chars:
+            parts.append(image.tostring(glyphs[char], "P"))
+        data = b"".join(parts)
+
+        # Huge glyphs would crowd everything else out of the cache
+        if len(data) > self.max_bytes:
+            return
+
+        try:
+            write_atomic(self.filename(path, font_size, smooth), data)
+            self.prune()
+        except (IOError, OSError):
+            # The cache is only a shortcut; we can live without it
+            pass
+
+    def prune(self):
+        """
+        Remove all but the max_files most recently used entries.
+        """
+        directory = os.path.dirname(cache_path(self.prefix))
+        entries = [os.path.join(directory, name)
+                   for name in os.listdir(directory)
+                   if name.startswith(self.prefix) and
+                   not name.endswith(".tmp")]
+        if len(entries) <= self.max_files:
+            return
+
+        entries.sort(key=os.path.getmtime)
+        for entry in entries[:-self.max_files]:
+            os.remove(entry)
+
+def clock_path(path, clock_id):
+    """
+    Return the path a clock should write an output to. A path with %d in it
+    gets one per clock; otherwise only the first clock gets one.
+    """
+    if path and "%d" in path:
+        return path % clock_id
+    if clock_id == 1:
+        return path
+    return None
+
+def get_atlas(font_name, font_size, color, bgcolor, smooth=False):
+    """
+    Return the glyph atlas for the given font and colors, coloring it in only
+    if we haven't already got one cached. Atlases are colored in from glyphs
+    every color shares, so changing colors never rasterizes the font again.
+    Without NumPy, smooth atlases have hard edges like any other.
+    """
+    smooth = smooth and numpy is not None
+    key = ("atlas", font_name, font_size, tuple(color), tuple(bgcolor),
+           smooth)
+    atlas = surface_cache.get(key)
+    if atlas is None:
+        glyphs = get_glyphs(font_name, font_size, smooth)
+        atlas = GlyphAtlas(glyphs, color, bgcolor, smooth)
+        surface_cache.add(key, atlas,
+                          glyph_bytes(glyphs) * ATLAS_COST_PER_PIXEL)
+    return atlas
+
+def get_glyphs(font_name, font_size, smooth):
+    """
+    Return a dict of each atlas character's glyph in the given font: an 8-bit
+    surface whose pixels say how much of them the glyph covers, from 0 to
+    255. Glyphs come from memory, else glyph_cache on disk, and only failing
+    both from the font itself, which is only loaded then.
+    """
+    key = ("glyphs", font_name, font_size, smooth)
+    glyphs = surface_cache.get(key)
+    if glyphs is None:
+        path = resolve_font(font_name)
+        if path is not None:
+            glyphs = glyph_cache.load(path, font_size, smooth)
+        if glyphs is None:
+            glyphs = rasterize_glyphs(load_font(font_name, font_size), smooth)
+
+            # Loading may have passed over a file that isn't a font after all
+            path = resolve_font(font_name)
+            if path is not None:
+                glyph_cache.save(path, font_size, smooth, glyphs)
+            stats.count("glyph_rasterizes")
+        else:
+            stats.count("glyph_cache_hits")
+        surface_cache.add(key, glyphs, glyph_bytes(glyphs))
+    return glyphs
+
+def glyph_bytes(glyphs):
+    """
+    Return how many bytes a glyph set's pixels take.
+    """
+    return sum([glyph.get_width() * glyph.get_height()
+                for glyph in glyphs.values()])
+
+def rasterize_glyphs(clock_font, smooth):
+    """
+    Rasterize each atlas character in clock_font, as get_glyphs returns them.
+    Smooth glyphs' anti-aliased alpha is their coverage; hard-edged ones
+    cover a pixel entirely or not at all. Smooth glyphs need NumPy.
+    """
+    glyphs = {}
+    for char in GlyphAtlas.chars:
+        if smooth:
+            rendered = clock_font.render(char, True, (255, 255, 255))
+            glyph = surfarray.make_surface(surfarray.array_alpha(rendered))
+        else:
+            rendered = clock_font.render(char, 0, (255, 255, 255), (0, 0, 0))
+            glyph = surface.Surface(rendered.get_size(), 0, 8)
+            glyph.set_palette(color_ramp((255, 255, 255), (0, 0, 0)))
+            glyph.blit(rendered, (0, 0))
+        glyphs[char] = glyph
+    return glyphs
+
+def text_layout(text):
+    """
+    Return text with every digit made 0. Texts alike but for their digits are
+    laid out alike, every digit taking the widest one's width.
+    """
+    return "".join([char.isdigit() and "0" or char for char in text])
+
+def measure_text(font_name, font_size, text):
+    """
+    Return roughly the size text would be drawn at in the given font. It's
+    measured from the font's glyphs if we've got them in memory or on disk,
+    so as not to load the font only to measure it.
+    """
+    sizes = None
+    for smooth in (False, True):
+        glyphs = surface_cache.get(("glyphs", font_name, font_size, smooth))
+        if glyphs is not None:
+            sizes = dict([(char, glyph.get_size())
+                          for char, glyph in glyphs.items()])
+
+    path = None
+    if sizes is None:
+        path = resolve_font(font_name)
+    if path is not None:
+        sizes = (glyph_cache.sizes(path, font_size, False) or
+                 glyph_cache.sizes(path, font_size, True))
+    if sizes is None:
+        return load_font(font_name, font_size).size(text)
+
+    # Laid out as GlyphAtlas would, with every digit as wide as the widest
+    digit_width = max([sizes[char][0] for char in "0123456789"])
+    width = 0
+    for char in text:
+        if char.isdigit():
+            width += digit_width
+        else:
+            width += sizes[char][0]
+    return width, max([size[1] for size in sizes.values()])
+
+def color_ramp(color, bgcolor):
+    """
+    Return a 256 color palette blending from bgcolor, at 0, to color, at 255,
+    so a pixel's index is how much of it the text covers.
+    """
+    return [tuple([(fg * weight + bg * (255 - weight) + 127) // 255
+                   for fg, bg in zip(color, bgcolor)])
+            for weight in range(256)]
+
+def draw_frame(bmp, surf):
+    """
+    Draw the palettized surf onto the wx.Bitmap bmp, expanding it to RGB a
+    strip of rows at a time, so a full color copy of the frame never exists
+    outside wx.
+    """
+    width, height = surf.get_size()
+    rows = max(FRAME_STRIP_BYTES // (width * 3), 1)
+    dc = wx.MemoryDC(bmp)
+    for y in range(0, height, rows):
+        strip = surf.subsurface((0, y, width, min(rows, height - y)))
+        dc.DrawBitmap(wx.BitmapFromBuffer(width, strip.get_height(),
+                                          image.tostring(strip, "RGB")),
+                      0, y)
+    dc.SelectObject(wx.NullBitmap)
+
+def frame_bytes(size):
+    """
+    Estimate the memory a clock needs to show frames of the given size.
+    """
+    pixels = size[0] * size[1]
+    return (pixels * FRAME_COST_PER_PIXEL +
+            min(pixels * PRERENDER_FRAMES, PRERENDER_MAX_BYTES))
+
+def compose_alpha(surf, atlas, text):
+    """
+    Blank a per-pixel alpha surf and draw text onto it, centred, with
+    anti-aliased edges over a transparent background. atlas must be smooth.
+    """
+    width, height = atlas.text_size(text)
+    surf.fill(tuple(atlas.color) + (0,))
+    alpha = surfarray.pixels_alpha(surf)
+    try:
+        atlas.blit_coverage(alpha, text, (surf.get_width() - width) // 2,
+                            (surf.get_height() - height) // 2)
+    finally:
+        # The surface stays locked for as long as the array is around
+        del alpha
+
+def build_shape(atlas, text, x, size, mask):
+    """
+    Build the window region for a frame of the given size, with text laid
+    out at x. Masked clocks get the union of each glyph's cached region,
+    offset to where it was drawn, rather than a scan of the whole bitmap.
+    """
+    width, height = size
+    if not mask:
+        return wx.Region(0, 0, width, height)
+
+    shape = wx.Region()
+    for char, cell_x in atlas.layout(text, x):
+        # Shift the cached region into place and back again afterwards,
+        # rather than copying it
+        region = atlas.glyph_region(char)
+        offset = cell_x + atlas.glyph_offset(char)
+        region.Offset(offset, 0)
+        shape.UnionRegion(region)
+        region.Offset(-offset, 0)
+    return shape
+
+def compose_frame(surf, atlas, text, bgcolor):
+    """
+    Blank surf and draw text onto it, centred horizontally.
+    """
+    justify = (surf.get_width() - atlas.text_size(text)[0]) // 2
+    surf.fill(bgcolor)
+    atlas.blit(surf, text, justify)
+
+def format_time(sec, precision=0):
+    """
+    Turn a number of seconds into the string the clock displays, dropping
+    leading fields that are zero down to a minimum of MM:SS. With a non-zero
+    precision, sec is in units of 1/10**precision seconds, and that many
+    decimal places of seconds are shown.
+    """
+    fraction = ""
+    if precision:
+        sec, units = divmod(sec, 10 ** precision)
+        fraction = ".%0*d" % (precision, units)
+
+    # Split the seconds up into d/h/m/s
+    timelist = []
+    timelist.append("%02d" % (sec // 86400))
+    sec = sec % 86400
+    timelist.append("%02d" % (sec // 3600))
+    sec = sec % 3600
+    timelist.append("%02d" % (sec // 60))
+    sec = sec % 60
+    timelist.append("%02d" % sec)
+
+    # Pop left-hand 0's until just m/s are left, if < 1hr
+    while timelist[0] == "00" and len(timelist) > 2:
+        timelist.pop(0)
+
+    return ':'.join(timelist) + fraction
+
+def refresh_rate():
+    """
+    Return the primary display's refresh rate in Hz, or a sensible guess if
+    wx can't tell us.
+    """
+    global display_refresh
+    if display_refresh is None:
+        display_refresh = DEFAULT_REFRESH_RATE
+        try:
+            mode = wx.Display(0).GetCurrentMode()
+            if mode.refresh > 0:
+                display_refresh = mode.refresh
+        except Exception:
+            pass
+    return display_refresh
+
+def load_font(font_name, font_size):
+    """
+    Attempt to load a font of the given name and size. Attempt in this order:
+
+    1.) Attempt to load a font of the given name from the PWD
+    2.) Append .ttf to the end and try again, if the name doesn't end in .ttf
+    3.) Attempt to return a system font
+    4.) Panic and return the system font "Sans", which should exist
+
+    This is made complex by pyinstaller's propensity to make created EXEs crash
+    when calling SysFont(), presumably due to not bundling Pygame's default
+    font into the EXE properly.
+
+    Loaded fonts are cached by file and size, and system font names are
+    looked up through font_index, so asking for the same font again is cheap.
+    A file that won't load as a font is noted in failed_fonts, so it's passed
+    over for the next choice until it changes.
+    """
+    while True:
+        path = resolve_font(font_name)
+        key = (path, font_size)
+        loaded = font_cache.get(key)
+        if loaded is not None:
+            return loaded
+
+        # pygame's font module is only started once we need a font
+        if not font.get_init():
+            font.init()
+
+        if path is not None:
+            try:
+                # Some pygames happily make a Font of a file that isn't one,
+                # and only complain once it's used
+                loaded = font.Font(path, font_size)
+                loaded.size(GlyphAtlas.chars)
+            except (IOError, RuntimeError):
+                # pygame.error is a RuntimeError
+                failed_fonts[path] = file_signature(path)
+                continue
+        else:
+            # If all else fails, panic and use "Sans" as a last resort
+            loaded = font.SysFont("Sans", font_size)
+        font_cache.add(key, loaded)
+        stats.count("font_loads")
+        return loaded
+
+def resolve_font(font_name):
+    """
+    Return the path of the font file load_font should use for font_name, or
+    None if it should fall back on "Sans".
+    """
+    # Try to just find the font in PWD, then with .ttf appended
+    candidates = [font_name]
+    if not font_name.endswith(".ttf"):
+        candidates.append(font_name + ".ttf")
+    for candidate in candidates:
+        if os.path.isfile(candidate) and not font_failed(candidate):
+            return os.path.abspath(candidate)
+
+    # If that failed, try to find it in system fonts
+    path = font_index.lookup(font_name)
+    if path is not None and font_failed(path):
+        return None
+    return path
+
+def font_failed(path):
+    """
+    Return whether the file at path failed to load as a font, and hasn't
+    changed since.
+    """
+    path = os.path.abspath(path)
+    return path in failed_fonts and failed_fonts[path] == file_signature(path)
+
+def file_signature(path):
+    """
+    Return the modification time and size of the file at path, or None if
+    there's no such file.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+def system_font_dirs():
+    """
+    Return the directories system fonts are usually installed into.
+    """
+    if sys.platform == "win32":
+        dirs = [os.path.join(os.environ.get("WINDIR", "C:\\Windows"), "Fonts")]
+    elif sys.platform == "darwin":
+        dirs = ["/Library/Fonts", "/System/Library/Fonts",
+                os.path.expanduser("~/Library/Fonts")]
+    else:
+        dirs = ["/usr/share/fonts", "/usr/local/share/fonts",
+                os.path.expanduser("~/.fonts"),
+                os.path.expanduser("~/.local/share/fonts")]
+    return [path for path in dirs if os.path.isdir(path)]
+
+def font_dir_tree():
+    """
+    Return the system font directories, and every directory within them.
+    """
+    dirs = []
+    for top in system_font_dirs():
+        for directory, subdirs, files in os.walk(top):
+            dirs.append(directory)
+    return dirs
+
+def cache_path(filename):
+    """
+    Return the path to filename in occult's cache directory, creating the
+    directory if need be.
+    """
+    path = os.path.join(os.path.expanduser("~"), ".occult")
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return os.path.join(path, filename)
+
+def write_atomic(path, data, sync=False):
+    """
+    Replace the file at path with data, such that anyone reading it sees
+    either all of the old contents or all of the new. With sync, the data is
+    on disk before it replaces the old, so even a crash can't lose both.
+    """
+    # Each process writes its own temporary file, so two replacing the same
+    # file at once can't interleave their data
+    temp = "%s.%d.tmp" % (path, os.getpid())
+    out = open(temp, "wb")
+    try:
+        out.write(data)
+        if sync:
+            out.flush()
+            os.fsync(out.fileno())
+    finally:
+        out.close()
+
+    try:
+        os.replace(temp, path)
+    except AttributeError:
+        # Python 2 has no os.replace, and its os.rename won't replace an
+        # existing file on Windows
+        if os.name == "nt" and os.path.exists(path):
+            os.remove(path)
+        os.rename(temp, path)
+
+# Extra time past a display change to fire the clock timer at, in ms, so we
+# aren't woken a hair early and forced to sleep again
+TIMER_SLACK_MS = 5
+
+def resume_elapsed(state, now, wall_now):
+    """
+    Return how long a clock with the given GetState() state has been running
+    since its anchor, as of monotonic time now and wall clock time wall_now.
+    The monotonic clock is immune to the wall clock being changed, but not
+    to a reboot, so it's only trusted while the two roughly agree.
+    """
+    wall_elapsed = wall_now - state["wall"]
+    elapsed = now - state["anchor"]
+    if elapsed >= 0 and abs(elapsed - wall_elapsed) < JOURNAL_CLOCK_SLOP:
+        return elapsed
+    return max(wall_elapsed, 0)
+
+def command_options(command):
+    """
+    Turn a control server "set" command into keyword arguments for
+    ClockFrame.SetOptions. Times may be seconds or [[DD:]HH:]MM:SS, and
+    colors lists or "R,G,B" strings.
+    """
+    options = {}
+    if "time" in command:
+        sec = command["time"]
+        if isinstance(sec, (int, float)):
+            sec = command_int(sec)
+        else:
+            sec = parse_time(str(sec))
+        if sec < 0:
+            raise ValueError("Times can't be negative")
+        options["sec"] = sec
+
+    for key in ("color", "bgcolor"):
+        if key in command:
+            color = command[key]
+            if not isinstance(color, list):
+                color = parse_color(str(color))
+            if len(color) != 3 or not all([0 <= command_int(n) <= 255
+                                           for n in color]):
+                raise ValueError("Colors must be three values from 0 to 255")
+            options[key] = tuple([command_int(n) for n in color])
+
+    if "font" in command:
+        font_name = command["font"]
+        if (not isinstance(font_name, (type(""), type(u""))) or
+                not font_name.strip()):
+            raise ValueError("Fonts must be given by name")
+        options["text_font"] = str(font_name)
+    if "size" in command:
+        if not 1 <= command_int(command["size"]) <= 4096:
+            raise ValueError("Size must be from 1 to 4096")
+        options["text_size"] = command_int(command["size"])
+    if "background" in command:
+        options["mask"] = not command["background"]
+    for key in ("aot", "countup"):
+        if key in command:
+            options[key] = bool(command[key])
+    if "precision" in command:
+        if not 0 <= command_int(command["precision"]) <= 2:
+            raise ValueError("Precision must be from 0 to 2")
+        options["precision"] = command_int(command["precision"])
+    return options
+
+def command_int(value):
+    """
+    Turn a number from a command into an int. JSON numbers too big for a
+    float, like 1e400, come out infinite, which int() can't take.
+    """
+    if isinstance(value, float) and (math.isinf(value) or math.isnan(value)):
+        raise ValueError("Numbers must be finite")
+    return int(value)
+
+def make_socketpair():
+    """
+    Return a pair of connected sockets. Python 2 on Windows has no
+    socket.socketpair(), so fall back on connecting two over loopback.
+    """
+    if hasattr(socket, "socketpair"):
+        return socket.socketpair()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    first = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    first.connect(listener.getsockname())
+    second = listener.accept()[0]
+    listener.close()
+    return first, second
+
+def websocket_frame(payload, opcode=0x1):
+    """
+    Wrap payload in an unmasked, unfragmented WebSocket frame. Text payloads
+    are encoded as UTF-8.
+    """
+    if not isinstance(payload, bytes):
+        payload = payload.encode("utf-8")
+
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+def parse_time(text):
+    """
+    Turn "[[DD:]HH:]MM:SS", or a plain number of seconds, into seconds.
+    """
+    total = 0
+    for field, scale in zip(reversed(text.split(":")), (1, 60, 3600, 86400)):
+        total += int(field) * scale
+    return total
+
+def parse_color(text):
+    """
+    Turn "R,G,B" into an (r, g, b) tuple.
+    """
+    color = tuple([int(c) % 256 for c in text.split(",")])
+    if len(color) != 3:
+        raise ValueError("Colors must be given as R,G,B")
+    return color
+
+def export_frames(path, start, duration, fps, countup, text_font, text_size,
+                  color, bgcolor, mask, fmt="png", processes=None,
+                  precision=0, smooth=True):
+    """
+    Render the clock headlessly as a sequence of frames, one file per frame
+    that actually looks different, plus an index mapping every frame number
+    to its file. Rendering is spread across a pool of processes.
+    """
+    # Work out what each frame shows, using the same time keeping as a live
+    # clock started at t=0
+    engine = ClockEngine(start, countup)
+    engine.anchor = 0.0
+    frame_count = int(round(duration * fps))
+    scale = 10 ** precision
+    frames = [format_time(engine.ticks(i / float(fps), scale), precision)
+              for i in range(frame_count)]
+
+    # Only distinct strings need rendering
+    unique = []
+    seen = set()
+    for text in frames:
+        if text not in seen:
+            seen.add(text)
+            unique.append(text)
+
+    # Every frame needs to be the same size, so size them to the widest
+    atlas = get_atlas(text_font, text_size, color, bgcolor, smooth)
+    size = (max([atlas.text_size(text)[0] for text in unique]), atlas.height)
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    filenames = dict([(text, "%s.%s" % (text.replace(":", "-"), fmt))
+                      for text in unique])
+    jobs = [(text, os.path.join(path, filenames[text])) for text in unique]
+
+    # Only exports need multiprocessing, so it's not imported up front
+    import multiprocessing
+    pool = multiprocessing.Pool(processes, _export_init,
+                                (text_font, text_size, color, bgcolor, mask,
+                                 fmt, size, smooth))
+    try:
+        for _ in pool.imap_unordered(_export_frame, jobs, 16):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+
+    index = open(os.path.join(path, "index.txt"), "w")
+    try:
+        index.write("# %d frames, %dx%d, %s fps\n" %
+                    (frame_count, size[0], size[1], fps))
+        for i, text in enumerate(frames):
+            index.write("%d %s\n" % (i, filenames[text]))
+    finally:
+        index.close()
+
+    return frame_count, len(unique)
+
+def _export_init(text_font, text_size, color, bgcolor, mask, fmt, size,
+                 smooth):
+    """
+    Set up an export worker process: build the atlas and surfaces every frame
+    it renders will reuse.
+    """
+    atlas = get_atlas(text_font, text_size, color, bgcolor, smooth)
+    _export_state["atlas"] = atlas
+    _export_state["bgcolor"] = bgcolor
+    _export_state["fmt"] = fmt
+    _export_state["surf"] = surface.Surface(size)
+
+    # With the background masked out, composite onto a transparent surface.
+    # Smooth glyphs are drawn straight onto it; hard ones are keyed out
+    _export_state["alpha"] = None
+    if mask:
+        _export_state["surf"].set_colorkey(bgcolor)
+        _export_state["alpha"] = surface.Surface(size, SRCALPHA, 32)
+
+def _export_frame(job):
+    text, filename = job
+    atlas = _export_state["atlas"]
+    alpha = _export_state["alpha"]
+    if alpha is not None and atlas.smooth:
+        compose_alpha(alpha, atlas, text)
+        surf = alpha
+    else:
+        surf = _export_state["surf"]
+        compose_frame(surf, atlas, text, _export_state["bgcolor"])
+        if alpha is not None:
+            alpha.fill((0, 0, 0, 0))
+            alpha.blit(surf, (0, 0))
+            surf = alpha
+
+    if _export_state["fmt"] == "rgba":
+        out = open(filename, "wb")
+        try:
+            out.write(image.tostring(surf, "RGBA"))
+        finally:
+            out.close()
+    else:
+        image.save(surf, filename)
+
+def main(argv=None):
+    global state_server, journal
+
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--export", metavar="DIR",
+                      help="Render frames into DIR instead of showing a clock")
+    parser.add_option("--start", default="%d:%d:%d" % (defaults["hr"],
+                                                        defaults["min"],
+                                                        defaults["sec"]),
+                      help="Clock time to start from, as [[DD:]HH:]MM:SS")
+    parser.add_option("--duration", type="float", default=60,
+                      help="Seconds of clock to export")
+    parser.add_option("--fps", type="float", default=30,
+                      help="Frames per second to export")
+    parser.add_option("--precision", type="int", default=defaults["precision"],
+                      help="Decimal places of seconds to show, up to 2")
+    parser.add_option("--cpu-budget", type="float",
+                      default=defaults["cpu_budget"],
+                      help="Most of the GUI thread, from 0 to 1, sub-second "
+                           "clocks may spend rendering")
+    parser.add_option("--countup", action="store_true",
+                      default=defaults["countup"], help="Count up, not down")
+    parser.add_option("--font", default=defaults["font"],
+                      help="Font name or file")
+    parser.add_option("--size", type="int", default=defaults["size"],
+                      help="Font size")
+    parser.add_option("--color", default="%d,%d,%d" % defaults["clockcolor"],
+                      help="Clock color as R,G,B")
+    parser.add_option("--bgcolor", default="%d,%d,%d" % defaults["bgcolor"],
+                      help="Background color as R,G,B")
+    parser.add_option("--show-background", action="store_true",
+                      default=not defaults["mask"],
+                      help="Keep the background instead of making it "
+                           "transparent")
+    parser.add_option("--format", choices=["png", "rgba"], default="png",
+                      help="Frame file format: png, or raw rgba")
+    parser.add_option("--processes", type="int",
+                      help="Number of render processes (default: one per CPU)")
+    parser.add_option("--journal", action="store_true", default=False,
+                      help="Journal clock state, and resume clocks from it "
+                           "when started")
+    parser.add_option("--journal-file", metavar="PATH",
+                      help="Journal to keep. Defaults to "
+                           "~/.occult/journal.jsonl")
+    parser.add_option("--control", action="store_true", default=False,
+                      help="Take commands from occult_ctl.py over a Unix "
+                           "domain socket")
+    parser.add_option("--control-socket", metavar="PATH",
+                      help="Socket to take commands on. Defaults to "
+                           "~/.occult/control.sock")
+    parser.add_option("--serve", metavar="[HOST:]PORT",
+                      help="Serve clock state over HTTP and WebSocket")
+    parser.add_option("--memory-limit", type="int", metavar="MB",
+                      default=defaults["memory_limit"],
+                      help="Draw clocks smaller rather than use more than MB "
+                           "megabytes each")
+    parser.add_option("--hard-edges", dest="smooth", action="store_false",
+                      default=defaults["smooth"],
+                      help="Don't anti-alias the clock's edges")
+    parser.add_option("--stats-file", metavar="FILE",
+                      help="Periodically write timing statistics to FILE "
+                           "as JSON")
+    parser.add_option("--stats-interval", type="float",
+                      default=defaults["stats_interval"],
+                      help="Seconds between writes of the stats file")
+    parser.add_option("--startup-times", action="store_true",
+                      default=defaults["startup_times"],
+                      help="Print how long each phase of starting up took, "
+                           "once the first clock is drawn")
+    parser.add_option("--text-file", metavar="PATH", dest="text_files",
+                      action="append", default=[],
+                      help="Write the time shown to PATH whenever it "
+                           "changes. May be given more than once")
+    parser.add_option("--no-window", dest="window", action="store_false",
+                      default=True,
+                      help="Don't draw the clock, only write text files")
+    parser.add_option("--shm", metavar="PATH",
+                      help="Publish frames to a shared memory ring in PATH, "
+                           "such as /dev/shm/occult")
+    parser.add_option("--shm-size", metavar="WxH",
+                      help="Size of shared memory frames. Defaults to the "
+                           "clock's size when first drawn")
+    parser.add_option("--shm-format", choices=["rgb", "rgba"],
+                      default=defaults["shm_format"],
+                      help="Pixel format of shared memory frames: rgb, or "
+                           "rgba")
+    parser.add_option("--stream", metavar="PATH",
+                      help="Stream the clock as raw video to PATH, a file or "
+                           "named pipe, or - for stdout")
+    parser.add_option("--stream-fps", type="float",
+                      default=defaults["stream_fps"],
+                      help="Frames per second to stream")
+    parser.add_option("--stream-size", metavar="WxH",
+                      help="Size of streamed frames (default: the clock's "
+                           "size when first drawn)")
+    parser.add_option("--stream-format", choices=["rgb", "rgba"],
+                      default=defaults["stream_format"],
+                      help="Pixel format to stream: rgb24 (rgb), or rgba")
+    options, args = parser.parse_args(argv)
+
+    if not 0 <= options.precision <= 2:
+        parser.error("Precision must be from 0 to 2")
+    if not 0 < options.cpu_budget <= 1:
+        parser.error("CPU budget must be more than 0, and at most 1")
+    if options.memory_limit <= 0:
+        parser.error("Memory limit must be more than 0")
+    defaults["precision"] = options.precision
+    defaults["cpu_budget"] = options.cpu_budget
+    defaults["smooth"] = options.smooth
+    defaults["memory_limit"] = options.memory_limit
+    defaults["stats_file"] = options.stats_file
+    defaults["stats_interval"] = options.stats_interval
+    defaults["startup_times"] = options.startup_times
+
+    if options.export:
+        try:
+            start = parse_time(options.start)
+            color = parse_color(options.color)
+            bgcolor = parse_color(options.bgcolor)
+        except ValueError:
+            parser.error("Bad time or color given")
+
+        export_frames(options.export, start, options.duration, options.fps,
+                      options.countup, options.font, options.size, color,
+                      bgcolor, not options.show_background, options.format,
+                      options.processes, options.precision, options.smooth)
+        return
+
+    defaults["text_files"] = options.text_files
+    defaults["window"] = options.window
+    if not options.window and (options.stream or options.shm):
+        parser.error("Can't publish frames without a window")
+
+    if options.stream:
+        defaults["stream"] = options.stream
+        defaults["stream_fps"] = options.stream_fps
+        defaults["stream_format"] = options.stream_format
+        if options.stream_size:
+            try:
+                defaults["stream_size"] = tuple(
+                    [int(n) for n in options.stream_size.split("x")])
+            except ValueError:
+                parser.error("Stream size must be given as WxH")
+
+    if options.shm:
+        defaults["shm"] = options.shm
+        defaults["shm_format"] = options.shm_format
+        if options.shm_size:
+            try:
+                defaults["shm_size"] = tuple(
+                    [int(n) for n in options.shm_size.split("x")])
+            except ValueError:
+                parser.error("Shared memory size must be given as WxH")
+
+    if options.serve:
+        host, port = "", options.serve
+        if ":" in port:
+            host, port = port.rsplit(":", 1)
+        try:
+            port = int(port)
+        except ValueError:
+            parser.error("Bad port given to serve on")
+        try:
+            state_server = StateServer(host, port)
+        except socket.error:
+            parser.error("Can't serve on %s: %s" %
+                         (options.serve, sys.exc_info()[1]))
+
+    if options.control and not hasattr(socket, "AF_UNIX"):
+        parser.error("Unix domain sockets aren't supported here")
+
+    if options.journal:
+        try:
+            journal = StateJournal(options.journal_file or
+                                   cache_path("journal.jsonl"))
+        except (IOError, OSError):
+            parser.error("Can't keep journal: %s" % sys.exc_info()[1])
+
+    # Stand up the wxPython app and display our control frame
+    app = wx.App()
+    stats.phase("app")
+    control = ControlFrame()
+    stats.phase("controls")
+
+    control_server = None
+    if options.control:
+        try:
+            control_server = ControlServer(options.control_socket or
+                                           cache_path("control.sock"),
+                                           control)
+        except (ValueError, socket.error):
+            parser.error("Can't take commands: %s" % sys.exc_info()[1])
+
+    control.Show()
+    app.MainLoop()
+
+    if control_server is not None:
+        control_server.close()
+    if journal is not None:
+        journal.close()
+
+# Per-process state for export workers, filled in by _export_init
+_export_state = {}
+
+# Refresh rate to assume if we can't ask the display, and the one we found
+DEFAULT_REFRESH_RATE = 60
+display_refresh = None
+
+# How much each render counts towards the running average of render cost
+RENDER_COST_WEIGHT = 0.2
+
+# How many frames ahead to render, and the most memory to spend doing it
+PRERENDER_FRAMES = 2
+PRERENDER_MAX_BYTES = 64 * 1024 * 1024
+
+# Roughly what a clock costs in memory for each pixel of its frame: a byte of
+# palettized frame, four of wx bitmap, and glyphs and their bitmaps worth
+# about one and a half frames. And the most to expand to RGB at once when
+# filling in the bitmap
+FRAME_COST_PER_PIXEL = 12
+FRAME_STRIP_BYTES = 1 << 20
+
+# Frames a stream may have queued for its reader before dropping some, and
+# how many drops to let pass between reports of them
+STREAM_QUEUE_SIZE = 4
+STREAM_REPORT_DROPS = 100
+
+# The layout of shared memory frame rings: the ring's header, and where in it
+# the latest sequence number is, then each slot's header and where its frame
+# starts. Both headers are padded out to SHM_HEADER and SLOT_DATA bytes. And
+# how many slots a ring has
+RING_HEADER = struct.Struct("<4sIIIIQ")
+RING_LATEST = 20
+SHM_HEADER = 64
+SLOT_HEADER = struct.Struct("<QQIIIId")
+SLOT_DATA = 64
+SHM_SLOTS = 3
+
+# Timing statistics and counters for every clock
+stats = Stats()
+
+# Writes every clock's text files
+text_writer = TextFileWriter()
+
+# The server publishing clock state, if we're running one
+state_server = None
+
+# The journal of clock state, if we're keeping one. Records are synced to
+# disk no more often than every JOURNAL_SYNC_INTERVAL seconds, and the journal
+# compacted when it holds more than JOURNAL_COMPACT_RECORDS. A replayed clock
+# trusts its monotonic anchor if it's within JOURNAL_CLOCK_SLOP seconds of its
+# wall clock one
+journal = None
+JOURNAL_SYNC_INTERVAL = 0.5
+JOURNAL_COMPACT_RECORDS = 1000
+JOURNAL_CLOCK_SLOP = 60
+
+# How many bytes of events a state subscriber may fall behind by before we
+# give up on it, the most we'll buffer of a frame from one, and the magic
+# number for WebSocket handshakes
+STATE_SERVER_MAX_BACKLOG = 1 << 20
+WEBSOCKET_MAX_FRAME = 4096
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# Loaded fonts, and the index of system font names to files. The font cache's
+# budget is in squared point sizes: about two fonts at the largest size
+font_cache = FontCache(2 * 4096 ** 2, 32)
+font_index = FontIndex("fonts.json")
+
+# Font files that wouldn't load, and their file_signature when they didn't
+failed_fonts = {}
+
+# Cached glyph atlases and glyph sets, within the memory limit. An atlas
+# costs roughly this many bytes for each pixel of its glyphs: a copy of them,
+# four for their wx bitmaps, and their coverage
+surface_cache = SurfaceCache()
+ATLAS_COST_PER_PIXEL = 6
+
+# The glyph cache on disk. Each entry starts with the magic number, and gives
+# each glyph's size as a pair of GLYPH_SIZEs. Only GLYPH_CACHE_FILES entries
+# of up to GLYPH_CACHE_BYTES are kept
+GLYPH_CACHE_MAGIC = b"OCCG\x01"
+GLYPH_SIZE = struct.Struct("<II")
+GLYPH_CACHE_FILES = 32
+GLYPH_CACHE_BYTES = 16 * 1024 * 1024
+glyph_cache = GlyphCache("glyphs-", GLYPH_CACHE_FILES, GLYPH_CACHE_BYTES)
+
+# A bunch of default settings
+# TODO: Replace with loading options from a config file
+defaults = {
+    "hr": 0,
+    "min": 1,
+    "sec": 0,
+    "clockcolor": (255, 255, 255),
+    "bgcolor": (255, 0, 255),
+    "font": "Sans",
+    "size": 256,
+    "mask": True,
+    "aot": False,
+    "countup": False,
+    "precision": 0,
+    "cpu_budget": 0.5,
+    "smooth": True,
+    "memory_limit": 256,
+    "stats_file": None,
+    "text_files": [],
+    "window": True,
+    "stats_interval": 10,
+    "startup_times": False,
+    "shm": None,
+    "shm_size": None,
+    "shm_format": "rgb",
+    "stream": None,
+    "stream_fps": 30,
+    "stream_size": None,
+    "stream_format": "rgb"
+}
+
+stats.phase("imports")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+"""
+Benchmarks for the stages of occult's clock rendering pipeline.
+
+Renders clocks headlessly, without creating any windows, across a sweep of
+font sizes, time ranges, and masking, timing each stage of a tick. Stages
+from the pipeline as it was before glyph atlases and shared frame buffers are
+timed alongside their replacements, for comparison.
+
+Results are printed as a table and written out as JSON, to compare between
+commits or machines:
+
+    python occult_bench.py --output results.json
+"""
+import json
+import optparse
+import platform
+import sys
+import time
+
+import pygame
+import wx
+from pygame import font, image, surface, SRCALPHA
+
+import occult
+
+try:
+    from time import perf_counter as timer
+except ImportError:
+    timer = time.time
+
+# Seconds to count down from for each time range, and the order they run in
+TIME_RANGES = {
+    "mm:ss": 59 * 60 + 59,
+    "hh:mm:ss": 23 * 3600 + 59 * 60 + 59,
+    "dd:hh:mm:ss": 99 * 86400 + 23 * 3600 + 59 * 60 + 59
+}
+RANGE_ORDER = ["mm:ss", "hh:mm:ss", "dd:hh:mm:ss"]
+
+DEFAULT_SIZES = "32,64,128,256,512,1024,2048,4096"
+
+def percentile(samples, fraction):
+    """
+    Return the given fraction's percentile of a sorted list of samples.
+    """
+    index = int(round(fraction * (len(samples) - 1)))
+    return samples[index]
+
+def summarize(samples, buffer_bytes):
+    """
+    Turn a list of stage timings, in seconds, into a dict of statistics in
+    milliseconds, plus the size of the buffers the stage creates each tick:
+    0 for stages that only draw into existing ones, and None where the size
+    isn't ours to know, as with wx regions.
+    """
+    samples = sorted(samples)
+    return {
+        "p50": percentile(samples, 0.5) * 1000,
+        "p90": percentile(samples, 0.9) * 1000,
+        "p99": percentile(samples, 0.99) * 1000,
+        "max": samples[-1] * 1000,
+        "mean": sum(samples) / len(samples) * 1000,
+        "buffer_bytes": buffer_bytes
+    }
+
+def bench_config(font_name, size, time_range, mask, iterations, use_wx):
+    """
+    Run one configuration for the given number of ticks, and return its
+    per-stage statistics.
+    """
+    color = occult.defaults["clockcolor"]
+    bgcolor = occult.defaults["bgcolor"]
+    clock_font = occult.load_font(font_name, size)
+
+    # Building the atlas is a one-off cost per font and color change.
+    # Rasterizing is timed without the glyph cache, and reading the cache
+    # separately, as a restarted clock would
+    occult.surface_cache.clear()
+    start = timer()
+    atlas = occult.GlyphAtlas(occult.rasterize_glyphs(clock_font, False),
+                              color, bgcolor)
+    atlas_time = timer() - start
+
+    path = occult.resolve_font(font_name)
+    cache_time = None
+    if path is not None:
+        occult.glyph_cache.save(path, size, False, atlas.glyphs)
+        start = timer()
+        cached = occult.glyph_cache.load(path, size, False)
+        if cached is not None:
+            occult.GlyphAtlas(cached, color, bgcolor)
+            cache_time = timer() - start
+
+    # A smooth atlas is rasterized once per font, then only recolored
+    smooth = occult.get_atlas(font_name, size, color, bgcolor, True)
+    start = timer()
+    occult.get_atlas(font_name, size, bgcolor, color, True)
+    recolor_time = timer() - start
+
+    # Size the frame for the widest time in the range, as a clock would
+    sec = TIME_RANGES[time_range]
+    frame_size = atlas.text_size(occult.format_time(sec))
+    framebuf = bytearray(frame_size[0] * frame_size[1])
+    bgsurf = image.frombuffer(framebuf, frame_size, "P")
+    bgsurf.set_palette(atlas.palette)
+
+    # The old pipeline drew into a full color surface
+    legacy_surf = surface.Surface(frame_size)
+    alpha = None
+    if smooth.smooth:
+        alpha = surface.Surface(frame_size, SRCALPHA, 32)
+    bmp = None
+    if use_wx:
+        bmp = wx.EmptyBitmap(frame_size[0], frame_size[1], 24)
+
+    timings = {}
+    buffers = {}
+
+    def record(stage, elapsed, nbytes):
+        timings.setdefault(stage, []).append(elapsed)
+        buffers[stage] = nbytes
+
+    for i in range(iterations):
+        start = timer()
+        text = occult.format_time(sec - i)
+        record("format", timer() - start, len(text))
+
+        # The old pipeline: rasterize the whole string, fill and blit
+        start = timer()
+        rendered = clock_font.render(text, 0, color, bgcolor)
+        record("font_render", timer() - start,
+               rendered.get_width() * rendered.get_height() *
+               rendered.get_bytesize())
+
+        start = timer()
+        legacy_surf.fill(bgcolor)
+        legacy_surf.blit(rendered,
+                         ((frame_size[0] - rendered.get_width()) // 2, 0))
+        record("fill_blit", timer() - start, 0)
+
+        # The current pipeline: blit cells from the atlas
+        start = timer()
+        occult.compose_frame(bgsurf, atlas, text, bgcolor)
+        record("atlas_compose", timer() - start, 0)
+
+        if alpha is not None:
+            start = timer()
+            occult.compose_alpha(alpha, smooth, text)
+            record("alpha_compose", timer() - start, 0)
+
+        start = timer()
+        image_string = image.tostring(legacy_surf, "RGB")
+        record("tostring", timer() - start, len(image_string))
+
+        if not use_wx:
+            continue
+
+        start = timer()
+        wx_image = wx.EmptyImage(*frame_size)
+        wx_image.SetData(image_string)
+        wx_image.SetMaskColour(*bgcolor)
+        wx_image.SetMask(mask)
+        old_bmp = wx_image.ConvertToBitmap()
+        record("wx_image", timer() - start,
+               len(image_string) +
+               frame_size[0] * frame_size[1] * old_bmp.GetDepth() // 8)
+
+        start = timer()
+        wx.RegionFromBitmap(old_bmp)
+        record("region_from_bitmap", timer() - start, None)
+
+        # draw_frame expands the frame to RGB a strip of rows at a time, so
+        # only a strip's worth is live at once. The bitmaps wx makes of the
+        # strips aren't counted
+        start = timer()
+        occult.draw_frame(bmp, bgsurf)
+        record("draw_frame", timer() - start, len(framebuf) * 3)
+
+        justify = (frame_size[0] - atlas.text_size(text)[0]) // 2
+        start = timer()
+        occult.build_shape(atlas, text, justify, frame_size, mask)
+        record("build_shape", timer() - start, None)
+
+    stages = {}
+    for stage, samples in timings.items():
+        stages[stage] = summarize(samples, buffers[stage])
+
+    return {
+        "size": size,
+        "range": time_range,
+        "mask": mask,
+        "frame": list(frame_size),
+        "frame_bytes": occult.frame_bytes(frame_size),
+        "atlas_ms": atlas_time * 1000,
+        "atlas_cached_ms": cache_time and cache_time * 1000,
+        "recolor_ms": recolor_time * 1000,
+        "stages": stages
+    }
+
+def print_result(result):
+    print("size %4d  %-11s  mask %-5s  frame %dx%d  atlas %.2fms  "
+          "cached %.2fms  recolor %.2fms" %
+          (result["size"], result["range"], result["mask"],
+           result["frame"][0], result["frame"][1], result["atlas_ms"],
+           result["atlas_cached_ms"] or 0, result["recolor_ms"]))
+    for stage in sorted(result["stages"]):
+        stats = result["stages"][stage]
+        buffer_bytes = "-"
+        if stats["buffer_bytes"] is not None:
+            buffer_bytes = str(stats["buffer_bytes"])
+        print("    %-20s p50 %9.3fms  p99 %9.3fms  max %9.3fms  %10s bytes" %
+              (stage, stats["p50"], stats["p99"], stats["max"],
+               buffer_bytes))
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--sizes", default=DEFAULT_SIZES,
+                      help="Comma separated font sizes to sweep")
+    parser.add_option("--ranges", default=",".join(RANGE_ORDER),
+                      help="Comma separated time ranges to sweep, from %s" %
+                           ", ".join(RANGE_ORDER))
+    parser.add_option("--iterations", type="int", default=60,
+                      help="Ticks to time per configuration")
+    parser.add_option("--font", default=occult.defaults["font"],
+                      help="Font name or file")
+    parser.add_option("--no-wx", action="store_true", default=False,
+                      help="Skip the wx stages, for machines with no display")
+    parser.add_option("--output", metavar="FILE",
+                      help="Write results as JSON to FILE")
+    options, args = parser.parse_args(argv)
+
+    try:
+        sizes = [int(size) for size in options.sizes.split(",")]
+    except ValueError:
+        parser.error("Sizes must be whole numbers")
+    ranges = options.ranges.split(",")
+    for time_range in ranges:
+        if time_range not in TIME_RANGES:
+            parser.error("Unknown time range %s" % time_range)
+
+    font.init()
+    use_wx = not options.no_wx
+    meta = {
+        "time": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "pygame": pygame.version.ver,
+        "font": options.font,
+        "iterations": options.iterations
+    }
+    if use_wx:
+        # wx needs an app before it will make bitmaps, but no windows
+        app = wx.App(False)
+        meta["wx"] = wx.VERSION_STRING
+
+    results = []
+    for size in sizes:
+        for time_range in ranges:
+            for mask in (False, True):
+                result = bench_config(options.font, size, time_range, mask,
+                                      options.iterations, use_wx)
+                print_result(result)
+                sys.stdout.flush()
+                results.append(result)
+
+    if options.output:
+        out = open(options.output, "w")
+        try:
+            json.dump({"meta": meta, "results": results}, out, indent=2,
+                      sort_keys=True)
+        finally:
+            out.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+Controls a running occult, started with --control, from the command line.
+
+Commands run in the order given, all in one go, against every clock unless
+"clock" picks which:
+
+    python occult_ctl.py start
+    python occult_ctl.py clock 2 time 5:00 color 255,0,0 start
+    python occult_ctl.py clock 1 pause clock 2 start
+    python occult_ctl.py get
+
+Commands are:
+
+    clock N[,N...]|all    Address the following commands to these clocks
+    clock new             Address them to the last clock "new" made
+    start, pause, get     Start, pause, or show the clocks
+    new                   Make a new clock, and address the rest to it
+    time [[DD:]HH:]MM:SS  Set the time
+    color R,G,B           Set the clock color
+    bgcolor R,G,B         Set the background color
+    font NAME, size N     Set the font and its size
+    background on|off     Show or mask out the background
+    countup on|off        Count up or down
+    precision N           Show N decimal places of seconds, up to 2
+
+Each clock addressed is printed afterwards, with the time it shows.
+"""
+import json
+import optparse
+import os
+import socket
+import sys
+
+# Commands that set an option, and how to read their argument
+SETTINGS = {
+    "time": str,
+    "color": str,
+    "bgcolor": str,
+    "font": str,
+    "size": int,
+    "background": lambda value: value == "on",
+    "countup": lambda value: value == "on",
+    "precision": int
+}
+
+# Seconds to wait on occult before giving up on it
+REPLY_TIMEOUT = 10
+
+def parse_commands(args):
+    """
+    Turn command line arguments into a list of control server commands.
+    Consecutive settings for the same clocks are gathered into one "set".
+    """
+    commands = []
+    clock = None
+    setting = None
+    args = list(args)
+    while args:
+        word = args.pop(0)
+        if word == "clock" or word in SETTINGS:
+            if not args:
+                raise ValueError("%s needs a value" % word)
+            value = args.pop(0)
+
+        if word == "clock":
+            clock = None
+            if value == "new":
+                clock = value
+            elif value != "all":
+                clock = [int(n) for n in value.split(",")]
+            setting = None
+        elif word in SETTINGS:
+            if setting is None:
+                setting = {"cmd": "set", "clock": clock}
+                commands.append(setting)
+            setting[word] = SETTINGS[word](value)
+        elif word == "new":
+            commands.append({"cmd": "new"})
+            clock = "new"
+            setting = None
+        elif word in ("start", "pause", "get"):
+            commands.append({"cmd": word, "clock": clock})
+            setting = None
+        else:
+            raise ValueError("Unknown command %s" % word)
+    return commands
+
+def send(path, commands, timeout=REPLY_TIMEOUT):
+    """
+    Send a batch of commands to occult, and return its results. Raises
+    socket.timeout if occult takes more than timeout seconds to reply.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(commands).encode("utf-8") + b"\n")
+        reply = b""
+        while not reply.endswith(b"\n"):
+            data = sock.recv(65536)
+            if not data:
+                raise socket.error("occult hung up")
+            reply += data
+    finally:
+        sock.close()
+    return json.loads(reply.decode("utf-8"))
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] COMMAND...")
+    parser.add_option("--socket", metavar="PATH",
+                      default=os.path.join(os.path.expanduser("~"), ".occult",
+                                           "control.sock"),
+                      help="Socket occult takes commands on")
+    parser.add_option("--json", action="store_true", default=False,
+                      help="Print occult's reply as JSON")
+    parser.add_option("--timeout", type="float", default=REPLY_TIMEOUT,
+                      metavar="SEC",
+                      help="Seconds to wait for occult to reply")
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error("Give at least one command")
+
+    try:
+        commands = parse_commands(args)
+    except ValueError:
+        parser.error(str(sys.exc_info()[1]))
+
+    try:
+        results = send(options.socket, commands, options.timeout)
+    except socket.error:
+        sys.stderr.write("Can't reach occult on %s: %s\n" %
+                         (options.socket, sys.exc_info()[1]))
+        return 1
+
+    if options.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    # Each clock's state as of the last command that addressed it
+    failed = False
+    clocks = {}
+    for result in results:
+        if result.get("ok"):
+            clocks.update(result["clocks"])
+        else:
+            sys.stderr.write("Error: %s\n" % result.get("error"))
+            failed = True
+
+    if not options.json:
+        for clock_id in sorted(clocks, key=int):
+            state = clocks[clock_id]
+            print("clock %s  %s  %s" %
+                  (clock_id, state["display"],
+                   state["paused"] and "paused" or "running"))
+    return failed and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
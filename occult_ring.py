@@ -0,0 +1,120 @@
+"""
+A reference reader for occult's shared memory frame rings.
+
+Waits for each new frame occult publishes with --shm, and prints its
+sequence number, size, and how long after it was written we got to it.
+With --output, the latest frame's pixels are written out raw as well:
+
+    python occult.py --shm /dev/shm/occult
+    python occult_ring.py /dev/shm/occult --output frame.rgb
+
+The layout of the ring is described in occult.FrameRing.
+"""
+import mmap
+import optparse
+import struct
+import sys
+import time
+
+# These mirror the constants in occult.py, so we needn't import wx or pygame
+RING_HEADER = struct.Struct("<4sIIIIQ")
+RING_LATEST = 20
+SLOT_HEADER = struct.Struct("<QQIIIId")
+SLOT_DATA = 64
+
+FORMATS = {1: "rgb", 2: "rgba"}
+
+def open_ring(path):
+    """
+    Map the ring at path, returning the map and its header fields.
+    """
+    ring = open(path, "rb")
+    try:
+        data = mmap.mmap(ring.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        ring.close()
+
+    magic, version, slots, slot_size, offset, latest = \
+        RING_HEADER.unpack_from(data, 0)
+    if magic != b"OCCR" or version != 1:
+        raise ValueError("%s isn't an occult frame ring" % path)
+    return data, slots, slot_size, offset
+
+def slot_start(slots, slot_size, offset, seq):
+    return offset + (seq % slots) * slot_size
+
+def read_frame(data, slots, slot_size, offset, seq):
+    """
+    Return (header, pixels) of frame seq, or None if the writer has moved on
+    from it or is writing it now. pixels is a memoryview into the ring, not a
+    copy, so once done with it, check it wasn't overwritten meanwhile with
+    frame_intact.
+    """
+    start = slot_start(slots, slot_size, offset, seq)
+    header = SLOT_HEADER.unpack_from(data, start)
+    count, frame_seq, width, height, stride = header[:5]
+    if count % 2 or frame_seq != seq:
+        return None
+
+    try:
+        pixels = memoryview(data)[start + SLOT_DATA:
+                                  start + SLOT_DATA + stride * height]
+    except TypeError:
+        # Python 2's mmaps predate memoryview
+        pixels = buffer(data, start + SLOT_DATA, stride * height)
+    return header, pixels
+
+def frame_intact(data, slots, slot_size, offset, header):
+    """
+    Return whether the frame read with header is still as it was read.
+    """
+    start = slot_start(slots, slot_size, offset, header[1])
+    return struct.unpack_from("<Q", data, start)[0] == header[0]
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] PATH")
+    parser.add_option("--output", metavar="FILE",
+                      help="Write the latest frame's raw pixels to FILE")
+    parser.add_option("--count", type="int", default=0,
+                      help="Stop after this many frames")
+    parser.add_option("--poll", type="float", default=0.002,
+                      help="Seconds between checks for a new frame")
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("Give the path of the ring to read")
+
+    data, slots, slot_size, offset = open_ring(args[0])
+    seen = 0
+    frames = 0
+    while not options.count or frames < options.count:
+        latest = struct.unpack_from("<Q", data, RING_LATEST)[0]
+        if latest == seen:
+            time.sleep(options.poll)
+            continue
+
+        frame = read_frame(data, slots, slot_size, offset, latest)
+        if frame is None:
+            # We raced the writer; there'll be a newer frame to read
+            continue
+
+        header, pixels = frame
+        count, seq, width, height, stride, fmt, stamp = header
+        if options.output:
+            out = open(options.output, "wb")
+            try:
+                out.write(pixels)
+            finally:
+                out.close()
+        del pixels
+        if not frame_intact(data, slots, slot_size, offset, header):
+            continue
+
+        print("frame %d  %dx%d %s  %.2fms old  %d skipped" %
+              (seq, width, height, FORMATS.get(fmt, "?"),
+               (time.time() - stamp) * 1000, max(seq - seen - 1, 0)))
+        sys.stdout.flush()
+        seen = latest
+        frames += 1
+
+if __name__ == '__main__':
+    main()
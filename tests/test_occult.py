@@ -0,0 +1,277 @@
+"""
+Tests for occult's time keeping, state journal, and control commands.
+
+Run from the top of the repository with:
+
+    python -m unittest discover tests
+"""
+import json
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import occult
+
+class ClockEngineTest(unittest.TestCase):
+    def engine(self, sec, countup=False):
+        engine = occult.ClockEngine(sec, countup)
+        engine.anchor = 0.0
+        return engine
+
+    def test_countdown_rounds_up(self):
+        engine = self.engine(60)
+        self.assertEqual(engine.ticks(0.0), 60)
+        self.assertEqual(engine.ticks(0.999), 60)
+        self.assertEqual(engine.ticks(1.0), 59)
+        self.assertEqual(engine.ticks(59.5), 1)
+        self.assertEqual(engine.ticks(60.0), 0)
+
+    def test_countdown_stops_at_zero(self):
+        engine = self.engine(5)
+        self.assertEqual(engine.ticks(100.0), 0)
+        self.assertEqual(engine.next_change(100.0), None)
+
+    def test_countup_rounds_down(self):
+        engine = self.engine(0, countup=True)
+        self.assertEqual(engine.ticks(0.999), 0)
+        self.assertEqual(engine.ticks(1.0), 1)
+        self.assertEqual(engine.ticks(61.5), 61)
+
+    def test_precision(self):
+        engine = self.engine(10)
+        self.assertEqual(engine.ticks(0.25, 100), 975)
+        self.assertEqual(engine.ticks(0.251, 10), 98)
+        self.assertEqual(occult.format_time(engine.ticks(0.25, 100), 2),
+                         "00:09.75")
+
+    def test_next_change(self):
+        self.assertAlmostEqual(self.engine(60).next_change(0.25), 0.75)
+        self.assertAlmostEqual(self.engine(60).next_change(0.25, 10), 0.05)
+        self.assertAlmostEqual(self.engine(0, True).next_change(0.25), 0.75)
+        self.assertAlmostEqual(self.engine(0, True).next_change(0.25, 100),
+                               0.01)
+
+    def test_next_change_lands_on_the_change(self):
+        engine = self.engine(60)
+        now = 0.3
+        shown = engine.ticks(now, 10)
+        now += engine.next_change(now, 10)
+        self.assertEqual(engine.ticks(now + 1e-9, 10), shown - 1)
+
+    def test_paused_never_changes(self):
+        engine = occult.ClockEngine(60)
+        self.assertEqual(engine.next_change(), None)
+        self.assertEqual(engine.ticks(), 60)
+
+class ResumeElapsedTest(unittest.TestCase):
+    state = {"anchor": 100.0, "wall": 1000.0}
+
+    def test_trusts_monotonic_clock(self):
+        self.assertEqual(occult.resume_elapsed(self.state, 130.0, 1030.0),
+                         30.0)
+
+    def test_ignores_wall_clock_being_set(self):
+        self.assertEqual(occult.resume_elapsed(self.state, 130.0, 1040.0),
+                         30.0)
+
+    def test_reboot_falls_back_on_wall_clock(self):
+        # The monotonic clock restarts from zero when the machine does
+        self.assertEqual(occult.resume_elapsed(self.state, 5.0, 1030.0),
+                         30.0)
+        self.assertEqual(occult.resume_elapsed(self.state, 5000.0, 1030.0),
+                         30.0)
+
+    def test_never_runs_backwards(self):
+        self.assertEqual(occult.resume_elapsed(self.state, 5.0, 900.0), 0)
+
+class StateJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "journal.jsonl")
+        self.saved = (occult.JOURNAL_SYNC_INTERVAL,
+                      occult.JOURNAL_COMPACT_RECORDS)
+        occult.JOURNAL_SYNC_INTERVAL = 0.01
+
+    def tearDown(self):
+        occult.JOURNAL_SYNC_INTERVAL, occult.JOURNAL_COMPACT_RECORDS = \
+            self.saved
+        shutil.rmtree(self.dir)
+
+    def lines(self):
+        journal = open(self.path, "rb")
+        try:
+            return journal.read().splitlines()
+        finally:
+            journal.close()
+
+    def write(self, *records):
+        out = open(self.path, "wb")
+        try:
+            for record in records:
+                out.write(record)
+        finally:
+            out.close()
+
+    def test_replay_ignores_torn_last_record(self):
+        self.write(b'{"clock": 1, "state": {"time": 60}}\n',
+                   b'{"clock": 2, "state": {"time": 30}}\n',
+                   b'{"clock": 1, "state": {"time": 45}}\n',
+                   b'{"clock": 2, "sta')
+        journal = occult.StateJournal(self.path)
+        try:
+            self.assertEqual(journal.replay(),
+                             {"1": {"time": 45}, "2": {"time": 30}})
+        finally:
+            journal.close()
+
+        # Opening compacts to one record a clock, torn tail and all gone
+        self.assertEqual(len(self.lines()), 2)
+        for line in self.lines():
+            json.loads(line.decode("utf-8"))
+
+    def test_closed_clocks_stay_closed(self):
+        journal = occult.StateJournal(self.path)
+        journal.record(1, {"time": 60})
+        journal.record(2, {"time": 30})
+        journal.forget(1)
+        journal.close()
+
+        journal = occult.StateJournal(self.path)
+        try:
+            self.assertEqual(journal.replay(), {"2": {"time": 30}})
+        finally:
+            journal.close()
+
+    def test_compacts_once_grown(self):
+        occult.JOURNAL_COMPACT_RECORDS = 5
+        journal = occult.StateJournal(self.path)
+        journal.record(1, {"time": 60})
+        for i in range(12):
+            journal.record(2, {"time": i})
+        journal.close()
+        # However the records were batched, the journal never holds more
+        # than the limit plus the one clock it was compacted down to
+        self.assertTrue(len(self.lines()) <= 2 + 5)
+
+        journal = occult.StateJournal(self.path)
+        try:
+            self.assertEqual(journal.replay(),
+                             {"1": {"time": 60}, "2": {"time": 11}})
+        finally:
+            journal.close()
+
+class CommandOptionsTest(unittest.TestCase):
+    def test_settings(self):
+        options = occult.command_options({
+            "time": "1:30", "color": "255,0,0", "bgcolor": [0, 0, 0],
+            "font": "Sans", "size": "72", "background": True,
+            "countup": 1, "precision": 2})
+        self.assertEqual(options, {
+            "sec": 90, "color": (255, 0, 0), "bgcolor": (0, 0, 0),
+            "text_font": "Sans", "text_size": 72, "mask": False,
+            "countup": True, "precision": 2})
+
+    def test_times_in_seconds(self):
+        self.assertEqual(occult.command_options({"time": 61.9}),
+                         {"sec": 61})
+
+    def test_rejects_bad_values(self):
+        for command in [{"time": -1}, {"time": "soon"},
+                        {"color": [256, 0, 0]}, {"color": "1,2"},
+                        {"size": -5}, {"size": 0}, {"size": 5000},
+                        {"size": None}, {"font": None}, {"font": ""},
+                        {"font": 12}, {"precision": 3},
+                        {"time": float("inf")}, {"size": float("nan")},
+                        {"color": [float("-inf"), 0, 0]}]:
+            self.assertRaises((ValueError, TypeError),
+                              occult.command_options, command)
+
+class ControlServerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "control.sock")
+
+    def tearDown(self):
+        # The server removes its socket as it stops, racing us to it
+        shutil.rmtree(self.dir, True)
+
+    def test_replaces_stale_socket(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+        server = occult.ControlServer(self.path, None)
+        server.close()
+
+    def test_always_replies(self):
+        class Control(object):
+            def RunCommands(self, commands):
+                raise OverflowError("cannot convert float infinity to integer")
+
+        server = occult.ControlServer(self.path, Control())
+        # Leave the reply for us to look at, not the serving thread
+        server.queue_replies = lambda: None
+        try:
+            server.run(None, [{"cmd": "set"}])
+            sock, reply = server.replies[0]
+            results = json.loads(reply.decode("utf-8"))
+            self.assertEqual(len(results), 1)
+            self.assertFalse(results[0]["ok"])
+        finally:
+            server.close()
+
+    def test_leaves_other_files_alone(self):
+        notes = open(self.path, "w")
+        notes.write("notes")
+        notes.close()
+        self.assertRaises(ValueError, occult.ControlServer, self.path, None)
+        self.assertEqual(open(self.path).read(), "notes")
+
+class StateServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = occult.StateServer("127.0.0.1", 0)
+        self.sock = socket.create_connection(
+            self.server.listener.getsockname(), 5)
+
+    def tearDown(self):
+        self.sock.close()
+        self.server.close()
+
+    def subscribe(self):
+        self.sock.sendall(b"GET /ws HTTP/1.1\r\n"
+                          b"Upgrade: websocket\r\n"
+                          b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+                          b"\r\n")
+        self.assertTrue(self.sock.recv(4096).startswith(b"HTTP/1.1 101"))
+
+    def hung_up(self):
+        try:
+            while self.sock.recv(4096):
+                pass
+        except socket.timeout:
+            return False
+        except socket.error:
+            pass
+        return True
+
+    def test_drops_oversized_frames(self):
+        self.subscribe()
+        self.sock.sendall(b"\x82\xff" + struct.pack("!Q", 1 << 40) +
+                          b"\0" * 4 + b"x" * 1000)
+        self.assertTrue(self.hung_up())
+
+    def test_answers_pings(self):
+        self.subscribe()
+        self.sock.sendall(b"\x89\x84" + b"\0" * 4 + b"ping")
+        reply = b""
+        while not reply.endswith(b"ping"):
+            reply += self.sock.recv(4096)
+        self.assertTrue(reply.endswith(b"\x8a\x04ping"))
+
+if __name__ == '__main__':
+    unittest.main()